@@ -0,0 +1,52 @@
+import argparse
+
+from pathlib import Path
+from time import perf_counter
+
+from core import LarcenyFeatureBuilder, NIBRSDataset, general
+
+def main(args: argparse.Namespace):
+    '''
+    Builds the larceny clearance feature table, one .parquet file per year, from the decoded segments. Only years 
+    whose segments changed since the last build are rebuilt.
+    '''
+    start = perf_counter()
+    output_dir, logger = general.create_output_dir(args.output_dir, f"{Path(__file__).stem}.log")
+    
+    if args.from_s3:
+        dataset = NIBRSDataset.from_s3_bucket(general.load_yaml(args.config_file)["s3_bucket"])
+    else:
+        dataset = NIBRSDataset(args.input_dir)
+    
+    builder = LarcenyFeatureBuilder(dataset, output_dir.joinpath("features"))
+    rebuilt_years = builder.build(years = args.years, force = args.force)
+    
+    logger.info(f"Rebuilt {len(rebuilt_years)} year(s): {', '.join(rebuilt_years) or 'none'}.")
+    
+    end = perf_counter()
+    
+    logger.info(f"Done. Total run time: {round((end - start) / 60, 2)} minutes.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Builds the larceny clearance feature table from decoded NIBRS segments.")
+    
+    parser.add_argument("--input_dir", "-i", 
+                        help = "directory with {segment_name}_{year}.parquet files",
+                        default = "output")
+    parser.add_argument("--output_dir", "-o", 
+                        default = "output")
+    parser.add_argument("--config_file", "-c", 
+                        help = ".yml file with s3_bucket key",
+                        default = "configuration/col_specs.yml")
+    parser.add_argument("--from_s3",
+                        help = "if toggled, segments are scanned from the S3 bucket instead of input_dir",
+                        action = "store_true")
+    parser.add_argument("--years", "-y", nargs = "+",
+                        help = "years to build, defaulting to every year with all segments decoded")
+    parser.add_argument("--force",
+                        help = "if toggled, years are rebuilt even if their segments are unchanged",
+                        action = "store_true")
+    
+    args = parser.parse_args()
+    
+    main(args)
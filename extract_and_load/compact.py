@@ -0,0 +1,70 @@
+import argparse
+
+from pathlib import Path
+from time import perf_counter
+
+from core import S3Compactor, general
+
+def main(args: argparse.Namespace):
+    '''
+    Rewrites the decoded segments in the S3 bucket into target-sized objects with one schema, row-group size, 
+    and compression, and swaps them in through a manifest per segment. Readers (NIBRSDataset.from_s3_bucket, 
+    db_ingestion.py, and find_duplicates.py --from_s3) pick up the compacted objects once the manifest is uploaded.
+    '''
+    start = perf_counter()
+    output_dir, logger = general.create_output_dir(args.output_dir, f"{Path(__file__).stem}.log")
+    
+    compactor = S3Compactor(
+        bucket_name = general.load_yaml(args.config_file)["s3_bucket"],
+        target_mb = args.target_mb,
+        row_group_size = args.row_group_size,
+        compression = args.compression
+    )
+    
+    for segment_name in args.segment_names:
+        manifest = compactor.compact(segment_name, years = args.years, force = args.force)
+        n_objects = sum(len(entry["objects"]) for entry in manifest["years"].values())
+        
+        logger.info(f"{segment_name}: version {manifest['version']} has {n_objects} object(s) across {len(manifest['years'])} year(s).")
+        
+        if args.vacuum:
+            deleted = compactor.vacuum(segment_name)
+            logger.info(f"{segment_name}: deleted {len(deleted)} unreferenced object(s).")
+    
+    end = perf_counter()
+    
+    logger.info(f"Done. Total run time: {round((end - start) / 60, 2)} minutes.")
+
+if __name__ == "__main__":
+    supported_segments = ("administrative_segment", "offense_segment", "arrestee_segment", "victim_segment")
+    
+    parser = argparse.ArgumentParser(description = "Compacts the decoded segments in the S3 bucket.")
+    
+    parser.add_argument("--output_dir", "-o",
+                        default = "output")
+    parser.add_argument("--config_file", "-c",
+                        help = ".yml file with s3_bucket key",
+                        default = "configuration/col_specs.yml")
+    parser.add_argument("--segment_names", "-s", nargs = "+", choices = supported_segments,
+                        default = list(supported_segments))
+    parser.add_argument("--years", "-y", nargs = "+",
+                        help = "years to consider, defaulting to all")
+    parser.add_argument("--target_mb", type = int,
+                        help = "approximate size of each compacted object",
+                        default = 256)
+    parser.add_argument("--row_group_size", type = int,
+                        help = "number of rows per row group",
+                        default = 250_000)
+    parser.add_argument("--compression",
+                        help = "parquet compression codec",
+                        default = "zstd")
+    parser.add_argument("--force",
+                        help = "if toggled, years are rewritten even if their source objects are unchanged",
+                        action = "store_true")
+    parser.add_argument("--vacuum",
+                        help = "if toggled, compacted objects no longer referenced by a manifest are deleted",
+                        action = "store_true")
+    
+    args = parser.parse_args()
+    
+    main(args)
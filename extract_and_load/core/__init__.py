@@ -1,3 +1,29 @@
-from .nibrs import *
-from .aws import AmazonS3
+import importlib
+
+from . import general
 from .general import *
+
+# Heavy submodules (pandas, polars, boto3, zipfile_deflate64) are only imported the first
+# time one of their classes is accessed: https://peps.python.org/pep-0562/
+_lazy_imports = {
+    "NIBRSUnzip": "nibrs",
+    "NIBRSDecoder": "nibrs",
+    "AmazonS3": "aws",
+    "DuplicateFinder": "duplicates",
+    "S3Compactor": "compaction",
+    "NIBRSDataset": "dataset",
+    "LarcenyFeatureBuilder": "features",
+    "HyperLogLog": "profiling",
+    "SegmentProfile": "profiling",
+}
+
+def __getattr__(name: str):
+    if name in _lazy_imports:
+        return getattr(importlib.import_module(f".{_lazy_imports[name]}", __name__), name)
+    elif name in set(_lazy_imports.values()):
+        return importlib.import_module(f".{name}", __name__)
+    
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+
+def __dir__() -> list:
+    return sorted(set(globals()) | set(_lazy_imports) | set(_lazy_imports.values()))
@@ -1,11 +1,17 @@
+from __future__ import annotations
+
+import json
 import os
-import boto3
-import pandas as pd
-import polars as pl
 
 from io import BytesIO, StringIO
-from botocore.client import BaseClient
-from botocore.exceptions import UnknownServiceError
+from typing import TYPE_CHECKING
+
+# boto3, pandas, and polars are imported where they are used so that importing this module is cheap.
+if TYPE_CHECKING:
+    import pandas as pd
+    import polars as pl
+    from botocore.client import BaseClient
+    from pyarrow.fs import S3FileSystem
 
 # https://stackoverflow.com/questions/53416226/how-to-write-parquet-file-from-pandas-dataframe-in-s3-in-python
 # https://stackoverflow.com/questions/75115246/with-python-is-there-a-way-to-load-a-polars-dataframe-directly-into-an-s3-bucke
@@ -19,15 +25,23 @@ warnings.filterwarnings(
 class AWSBase:
     '''
     Instantiates boto3 client. If no credentials are passed, region_name; aws_access_key_id; 
-    and aws_secret_access_key are pulled from environment variables of the same name.
+    and aws_secret_access_key are pulled from environment variables of the same name when the
+    instance is created (not when this module is imported).
     '''
     def __init__(self, 
-                 region_name: str = os.environ["region_name"], 
-                 aws_access_key_id: str = os.environ["aws_access_key_id"], 
-                 aws_secret_access_key: str = os.environ["aws_secret_access_key"]):
-        self.region_name = region_name
-        self.aws_access_key_id = aws_access_key_id
-        self.aws_secret_access_key = aws_secret_access_key
+                 region_name: str = None, 
+                 aws_access_key_id: str = None, 
+                 aws_secret_access_key: str = None):
+        self.region_name = region_name or AWSBase._get_environment_variable("region_name")
+        self.aws_access_key_id = aws_access_key_id or AWSBase._get_environment_variable("aws_access_key_id")
+        self.aws_secret_access_key = aws_secret_access_key or AWSBase._get_environment_variable("aws_secret_access_key")
+
+    @staticmethod
+    def _get_environment_variable(name: str) -> str:
+        try:
+            return os.environ[name]
+        except KeyError:
+            raise KeyError(f"No {name} passed and no environment variable of the same name found.")
 
     def _create_credentials_dict(self) -> dict:
         credentials = {
@@ -39,6 +53,9 @@ class AWSBase:
         return credentials
         
     def _create_client(self, service: str) -> BaseClient:
+        import boto3
+        from botocore.exceptions import UnknownServiceError
+        
         try:
             client = boto3.client(service, **self._create_credentials_dict())
             return client
@@ -64,6 +81,34 @@ class AmazonS3(AWSBase):
         except KeyError:
             raise KeyError(f"No objects found in {bucket_name}.")
 
+    def list_objects_in_s3_bucket(self, bucket_name: str, prefix: str = "") -> list:
+        '''
+        prefix: If specified, only objects whose names start with prefix are listed.
+        
+        Returns the Key, Size, ETag, and LastModified of every object, paginating past list_objects_v2's 1,000-key limit.
+        '''
+        paginator = self._create_client("s3").get_paginator("list_objects_v2")
+        
+        return [
+            {key: object[key] for key in ("Key", "Size", "ETag", "LastModified")}
+            for page in paginator.paginate(Bucket = bucket_name, Prefix = prefix)
+            for object in page.get("Contents", [])
+        ]
+    
+    def read_json_from_s3_bucket(self, bucket_name: str, object_name: str) -> dict:
+        response = self.get_object_attributes_from_s3_bucket(bucket_name = bucket_name, object_name = object_name)
+        
+        return json.loads(response["Body"].read())
+    
+    def delete_objects_from_s3_bucket(self, bucket_name: str, object_names: list) -> None:
+        client = self._create_client("s3")
+        
+        for i in range(0, len(object_names), 1000): # delete_objects accepts at most 1,000 keys per request
+            client.delete_objects(
+                Bucket = bucket_name, 
+                Delete = {"Objects": [{"Key": object_name} for object_name in object_names[i:i + 1000]]}
+                )
+
     def upload_table_to_s3_bucket(self, 
                                   table: pd.DataFrame, 
                                   how: str, 
@@ -90,6 +135,18 @@ class AmazonS3(AWSBase):
         
         self._create_client("s3").upload_fileobj(out_buffer, Bucket = bucket_name, Key = object_name)
         
+    def upload_dict_to_s3_bucket(self, dictionary: dict, bucket_name: str, object_name: str) -> None:
+        '''
+        dictionary: JSON-serializable dictionary (e.g., a segment profile).
+        bucket_name: Name of S3 bucket.
+        object_name: File name to use in S3 bucket.
+        
+        Uploads dictionary to an S3 bucket as a .json file.
+        '''
+        out_buffer = BytesIO(json.dumps(dictionary, indent = 2).encode())
+        
+        self._create_client("s3").upload_fileobj(out_buffer, Bucket = bucket_name, Key = object_name)
+        
     def upload_file_to_s3_bucket(self, file: str, bucket_name: str, object_name: str) -> None:
         '''
         file: Path to file.
@@ -117,6 +174,8 @@ class AmazonS3(AWSBase):
         
         Loads a parquet file from an S3 bucket into a Polars dataframe.
         '''
+        import polars as pl
+        
         if object_name.endswith("parquet"):
             response = self.get_object_attributes_from_s3_bucket(bucket_name = bucket_name, object_name = object_name)
             
@@ -125,3 +184,24 @@ class AmazonS3(AWSBase):
             return out_table
         else:
             raise Exception("{object_name} does not end with .parquet.")
+    
+    def create_storage_options(self) -> dict:
+        '''
+        Returns the credentials as storage_options for Polars' scan_parquet and read_parquet on s3:// paths.
+        '''
+        return {
+            "aws_region": self.region_name,
+            "aws_access_key_id": self.aws_access_key_id,
+            "aws_secret_access_key": self.aws_secret_access_key
+        }
+    
+    def create_pyarrow_filesystem(self) -> S3FileSystem:
+        '''
+        Returns a pyarrow filesystem with the same credentials, so that objects can be streamed 
+        (e.g., one row group at a time) as bucket_name/object_name paths instead of downloaded whole.
+        '''
+        from pyarrow.fs import S3FileSystem
+        
+        return S3FileSystem(region = self.region_name, 
+                            access_key = self.aws_access_key_id, 
+                            secret_key = self.aws_secret_access_key)
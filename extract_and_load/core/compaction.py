@@ -0,0 +1,269 @@
+from __future__ import annotations
+
+import re
+import tempfile
+
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import polars as pl
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+if TYPE_CHECKING:
+    from pyarrow.fs import S3FileSystem
+
+    from .aws import AmazonS3
+
+# https://arrow.apache.org/docs/python/generated/pyarrow.parquet.ParquetWriter.html
+# https://docs.aws.amazon.com/AmazonS3/latest/userguide/Welcome.html#ConsistencyModel
+
+MB = 1024 * 1024
+
+class S3Compactor:
+    file_pattern = re.compile(r"([a-z]+_segment)_([0-9]{4})\.parquet")
+    compacted_prefix = "compacted"
+    manifest_prefix = "manifests"
+
+    def __init__(self,
+                 bucket_name: str,
+                 S3: AmazonS3 = None,
+                 target_mb: int = 256,
+                 row_group_size: int = 250_000,
+                 compression: str = "zstd"):
+        '''
+        bucket_name: Name of S3 bucket with the decoded ${segment_name}_${year}.parquet objects.
+        S3: If not specified, an AmazonS3 instance is created from environment variables.
+        target_mb: Approximate size of each compacted object.
+        row_group_size: Number of rows per row group. Every row group but the last of each year has exactly this many.
+        compression: Parquet compression codec of the compacted objects (e.g., zstd, snappy).
+
+        Rewrites the decoded objects of a segment into compacted/${segment_name}/v${version}/ with one schema
+        (every column as a string, as in the raw tables), one row-group size, and one codec, then publishes
+        them by uploading manifests/${segment_name}.json. A single PUT is atomic in S3, so readers see either
+        the previous manifest or the new one, never a partial rewrite. Years are never mixed within an object,
+        so ingestion can still be tracked per ${segment_name}_${year}.parquet source file.
+        '''
+        from .aws import AmazonS3
+
+        self.bucket_name = bucket_name
+        self.S3 = S3 or AmazonS3()
+        self.target_mb = target_mb
+        self.row_group_size = row_group_size
+        self.compression = compression
+
+    @staticmethod
+    def manifest_name(segment_name: str) -> str:
+        return f"{S3Compactor.manifest_prefix}/{segment_name}.json"
+
+    def _list_source_objects(self) -> dict:
+        '''
+        Returns {object_name: ETag} of the ${segment_name}_${year}.parquet objects at the root of the bucket.
+        '''
+        return {
+            object["Key"]: object["ETag"] for object in self.S3.list_objects_in_s3_bucket(bucket_name = self.bucket_name)
+            if S3Compactor.file_pattern.fullmatch(object["Key"])
+        }
+
+    def load_manifest(self, segment_name: str) -> dict:
+        '''
+        Returns the current manifest of segment_name, or None if it was never compacted.
+        '''
+        from botocore.exceptions import ClientError
+
+        try:
+            return self.S3.read_json_from_s3_bucket(bucket_name = self.bucket_name, object_name = S3Compactor.manifest_name(segment_name))
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "NoSuchKey":
+                return None
+            raise
+
+    def list_segment_files(self) -> dict:
+        '''
+        Returns {(segment_name, year): [object_name, ...]} for every decoded segment and year: the compacted objects
+        if the manifest covers the year's current source object (same ETag), else the source object itself. A year
+        that is decoded again after compaction is therefore read from its new object until it is compacted again.
+        '''
+        source_objects = self._list_source_objects()
+        manifests = {}
+        files = {}
+
+        for object_name, etag in source_objects.items():
+            segment_name, year = S3Compactor.file_pattern.fullmatch(object_name).groups()
+
+            if segment_name not in manifests:
+                manifests[segment_name] = self.load_manifest(segment_name) or {"years": {}}
+
+            entry = manifests[segment_name]["years"].get(year)
+            if entry and entry["source_etag"] == etag:
+                files[(segment_name, year)] = entry["objects"]
+            else:
+                files[(segment_name, year)] = [object_name]
+
+        return dict(sorted(files.items()))
+
+    def list_source_etags(self) -> dict:
+        '''
+        Returns {(segment_name, year): ETag} of the ${segment_name}_${year}.parquet objects. A year that is decoded and
+        uploaded again keeps its object name, so the ETag is what tells that it changed.
+        '''
+        return {
+            S3Compactor.file_pattern.fullmatch(object_name).groups(): etag 
+            for object_name, etag in sorted(self._list_source_objects().items())
+        }
+
+    def _compact_year(self, source_file: str, schema: pa.Schema, out_prefix: str, tmp_dir: Path, filesystem: S3FileSystem) -> tuple:
+        '''
+        Streams source_file one row group at a time into objects of about target_mb each.
+        Returns the uploaded object names and the number of rows written.
+        '''
+        parquet_file = pq.ParquetFile(filesystem.open_input_file(f"{self.bucket_name}/{source_file}"))
+        stem = source_file.replace(".parquet", "")
+
+        object_names = []
+        n_rows = 0
+        buffer, buffered_rows = [], 0
+        writer, out_file = None, None
+
+        def upload() -> None:
+            writer.close()
+            object_name = f"{out_prefix}/{stem}-{len(object_names):04d}.parquet"
+            self.S3.upload_file_to_s3_bucket(file = str(out_file), bucket_name = self.bucket_name, object_name = object_name)
+            out_file.unlink()
+            object_names.append(object_name)
+
+        def write_row_groups(flush: bool) -> None:
+            nonlocal buffer, buffered_rows, writer, out_file
+
+            table = pa.concat_tables(buffer)
+            while table.num_rows >= self.row_group_size or (flush and table.num_rows):
+                if writer is None:
+                    out_file = tmp_dir.joinpath(f"{stem}-{len(object_names):04d}.parquet")
+                    writer = pq.ParquetWriter(out_file, schema, compression = self.compression)
+
+                writer.write_table(table.slice(0, self.row_group_size), row_group_size = self.row_group_size)
+                table = table.slice(self.row_group_size)
+
+                if out_file.stat().st_size >= self.target_mb * MB:
+                    upload()
+                    writer = None
+
+            buffer, buffered_rows = [table], table.num_rows
+
+        for record_batch in parquet_file.iter_batches(batch_size = self.row_group_size):
+            batch = pl.from_arrow(record_batch).with_columns(pl.all().cast(pl.Utf8))
+            missing_columns = [name for name in schema.names if name not in batch.columns]
+            batch = batch.with_columns(pl.lit(None, dtype = pl.Utf8).alias(name) for name in missing_columns)
+
+            buffer.append(batch.select(schema.names).to_arrow().cast(schema))
+            buffered_rows += batch.height
+            n_rows += batch.height
+
+            if buffered_rows >= self.row_group_size:
+                write_row_groups(flush = False)
+
+        if buffer:
+            write_row_groups(flush = True)
+        if writer is not None:
+            upload()
+
+        return object_names, n_rows
+
+    def compact(self, segment_name: str, years: list = None, force: bool = False) -> dict:
+        '''
+        segment_name: Segment to compact (e.g., victim_segment).
+        years: Years to consider, defaulting to all. Only those whose source object, columns, or compaction settings
+        changed since the last compaction are rewritten.
+        force: If True, years are rewritten even if nothing changed.
+
+        Uploads every compacted object of the new version first and the manifest last. Years that are up-to-date
+        keep pointing to the objects of earlier versions. Returns the new manifest, or the current one if nothing changed.
+        '''
+        source_objects = {
+            object_name: etag for object_name, etag in self._list_source_objects().items()
+            if S3Compactor.file_pattern.fullmatch(object_name).group(1) == segment_name
+        }
+        if not source_objects:
+            raise KeyError(f"No {segment_name} objects found in {self.bucket_name}.")
+
+        previous = self.load_manifest(segment_name) or {"version": 0, "years": {}}
+
+        filesystem = self.S3.create_pyarrow_filesystem()
+        column_names = []
+        for object_name in sorted(source_objects):
+            for name in pq.read_schema(filesystem.open_input_file(f"{self.bucket_name}/{object_name}")).names:
+                if name not in column_names:
+                    column_names.append(name)
+
+        schema = pa.schema([(name, pa.string()) for name in column_names])
+        # Years that are not rewritten keep their entry, so settings and columns are recorded per year.
+        settings = {
+            "target_mb": self.target_mb, 
+            "row_group_size": self.row_group_size, 
+            "compression": self.compression, 
+            "columns": column_names
+            }
+
+        manifest = {
+            "segment_name": segment_name,
+            "version": previous["version"] + 1,
+            "created": datetime.now(timezone.utc).isoformat(timespec = "seconds"),
+            "years": {}
+        }
+        out_prefix = f"{S3Compactor.compacted_prefix}/{segment_name}/v{manifest['version']:04d}"
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for object_name, etag in sorted(source_objects.items()):
+                year = S3Compactor.file_pattern.fullmatch(object_name).group(2)
+                entry = previous["years"].get(year)
+
+                is_selected = years is None or year in map(str, years)
+                is_up_to_date = (
+                    entry is not None and entry["source_etag"] == etag 
+                    and all(entry.get(key) == value for key, value in settings.items())
+                    )
+
+                if not is_selected or (is_up_to_date and not force):
+                    if entry is not None:
+                        manifest["years"][year] = entry
+                    continue
+
+                print(f"Compacting {object_name}...")
+
+                objects, n_rows = self._compact_year(object_name, schema, out_prefix, Path(tmp_dir), filesystem)
+                manifest["years"][year] = {
+                    "source_file": object_name,
+                    "source_etag": etag,
+                    **settings,
+                    "n_rows": n_rows,
+                    "objects": objects
+                }
+
+        if manifest["years"] == previous["years"]:
+            return previous
+
+        self.S3.upload_dict_to_s3_bucket(dictionary = manifest, bucket_name = self.bucket_name, object_name = S3Compactor.manifest_name(segment_name))
+
+        return manifest
+
+    def vacuum(self, segment_name: str) -> list:
+        '''
+        Deletes the compacted objects of segment_name that its current manifest no longer references. Readers that
+        listed the bucket before the last compaction may still be reading them, so run this only between jobs.
+        Returns the deleted object names.
+        '''
+        manifest = self.load_manifest(segment_name) or {"years": {}}
+        referenced = {object_name for entry in manifest["years"].values() for object_name in entry["objects"]}
+
+        unreferenced = [
+            object["Key"] for object in self.S3.list_objects_in_s3_bucket(
+                bucket_name = self.bucket_name, prefix = f"{S3Compactor.compacted_prefix}/{segment_name}/"
+                )
+            if object["Key"] not in referenced
+        ]
+
+        if unreferenced:
+            self.S3.delete_objects_from_s3_bucket(bucket_name = self.bucket_name, object_names = unreferenced)
+
+        return unreferenced
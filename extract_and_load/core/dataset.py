@@ -0,0 +1,239 @@
+from __future__ import annotations
+
+import re
+
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import polars as pl
+
+if TYPE_CHECKING:
+    from .aws import AmazonS3
+
+# https://docs.pola.rs/user-guide/lazy/optimizations/
+# https://docs.pola.rs/user-guide/io/cloud-storage/
+# https://arrow.apache.org/docs/python/feather.html
+
+class NIBRSDataset:
+    key_columns = ["data_year", "ori", "incident_number"]
+    shared_columns = ["segment_level", "state_code", "incident_date"]
+    file_pattern = re.compile(r"([a-z]+_segment)_([0-9]{4})\.(parquet|arrow)")
+    arrow_compressions = ("uncompressed", "lz4")
+    
+    def __init__(self, source: str = "output", storage_options: dict = None, object_names: dict = None, etags: dict = None):
+        '''
+        source: Local directory with the decoded ${segment_name}_${year}.parquet (or .arrow) files, or s3://${bucket_name}.
+        storage_options: Credentials for s3:// sources (see AmazonS3.create_storage_options).
+        object_names: {(segment_name, year): [object_name, ...]} in source. Required for s3:// sources, which is what
+        from_s3_bucket() does, so that compacted segments are read through their manifest (see S3Compactor).
+        etags: {(segment_name, year): ETag} of the decoded objects in source, which from_s3_bucket() also passes, so 
+        that a year uploaded again under the same name can be told apart (see LarcenyFeatureBuilder).
+        
+        Exposes every decoded year and segment as Polars LazyFrames. Nothing is read until a query is collected, 
+        so filters and column selections are pushed down into the .parquet scans, and collect() runs the query 
+        with the streaming engine to keep multi-year queries within bounded memory. Local Arrow IPC caches (see 
+        convert_to_arrow) are read instead of their .parquet files and are memory-mapped: uncompressed ones are 
+        read zero-copy, and their pages are shared by every process that maps the same file.
+        '''
+        self.source = str(source).rstrip("/")
+        self.storage_options = storage_options
+        self.files = self._list_files(object_names)
+        self.etags = etags or {}
+    
+    @classmethod
+    def from_s3_bucket(cls, bucket_name: str, S3: AmazonS3 = None) -> NIBRSDataset:
+        '''
+        S3: If not specified, an AmazonS3 instance is created from environment variables.
+        '''
+        from .aws import AmazonS3
+        from .compaction import S3Compactor
+        
+        S3 = S3 or AmazonS3()
+        compactor = S3Compactor(bucket_name, S3)
+        
+        return cls(source = f"s3://{bucket_name}", 
+                   storage_options = S3.create_storage_options(), 
+                   object_names = compactor.list_segment_files(),
+                   etags = compactor.list_source_etags())
+    
+    @property
+    def is_remote(self) -> bool:
+        return self.source.startswith("s3://")
+    
+    def _list_files(self, object_names: dict = None) -> dict:
+        '''
+        object_names: See __init__. If not specified, source is listed as a local directory.
+        
+        Returns {(segment_name, year): [path, ...]} for every segment and year, e.g., the one local file of form
+        ${segment_name}_${year}.parquet, or the compacted objects of a year. Local .arrow files are preferred over 
+        .parquet files of the same segment and year, unless they are older.
+        '''
+        if object_names is None:
+            if self.is_remote:
+                raise ValueError("Use NIBRSDataset.from_s3_bucket() for s3:// sources.")
+            
+            object_names = {}
+            # Oldest first, so that the newest of a segment and year's .parquet and .arrow files wins.
+            for file in sorted(Path(self.source).glob("*_segment_*.*"), key = lambda file: file.stat().st_mtime):
+                match = NIBRSDataset.file_pattern.fullmatch(file.name)
+                if match:
+                    segment_name, year, _ = match.groups()
+                    object_names[(segment_name, year)] = [file.name]
+        
+        files = {key: [f"{self.source}/{name}" for name in names] for key, names in object_names.items()}
+        
+        return dict(sorted(files.items()))
+    
+    @staticmethod
+    def is_memory_mappable(path: str) -> bool:
+        '''
+        Tells whether an .arrow file was written uncompressed by convert_to_arrow, which records its compression in 
+        the schema metadata, with Polars' own string layout (string_view), which Polars maps without converting it. 
+        Only the footer is read.
+        '''
+        import pyarrow as pa
+        
+        with pa.memory_map(str(path)) as source:
+            schema = pa.ipc.open_file(source).schema
+        
+        return ((schema.metadata or {}).get(b"nibrs_arrow_compression") == b"uncompressed"
+                and not any(pa.types.is_string(field.type) or pa.types.is_large_string(field.type) for field in schema))
+    
+    def _scan_file(self, paths: list) -> pl.LazyFrame:
+        if paths[0].endswith(".arrow"):
+            if NIBRSDataset.is_memory_mappable(paths[0]):
+                # scan_ipc copies the mapped buffers when the query is collected, so the mapped frames are wrapped instead.
+                return pl.concat([NIBRSDataset.read_file(path).lazy() for path in paths], how = "diagonal_relaxed")
+            
+            return pl.scan_ipc(paths, memory_map = False)
+        
+        return pl.scan_parquet(paths, storage_options = self.storage_options)
+    
+    @staticmethod
+    def read_file(path: str, storage_options: dict = None) -> pl.DataFrame:
+        '''
+        Reads one decoded file: uncompressed .arrow files are memory-mapped, other files are read (and decompressed) in full.
+        '''
+        if str(path).endswith(".arrow"):
+            if NIBRSDataset.is_memory_mappable(path):
+                return pl.read_ipc(path, memory_map = True, rechunk = False)
+            
+            return pl.read_ipc(path, memory_map = False)
+        
+        return pl.read_parquet(path, storage_options = storage_options)
+    
+    @staticmethod
+    def convert_to_arrow(parquet_file: Path, compression: str = "uncompressed", batch_size: int = 250_000) -> Path:
+        '''
+        parquet_file: Local ${segment_name}_${year}.parquet file.
+        compression: uncompressed (memory-mapped zero-copy) or lz4 (smaller, but decompressed when read).
+        batch_size: Number of rows converted at a time.
+        
+        Writes parquet_file as an Arrow IPC file (Feather v2) next to it, e.g., victim_segment_2022.arrow, one batch 
+        at a time. The .parquet file is kept, since it remains the format that is uploaded and ingested. Strings are 
+        written as string_view, the layout Polars uses in memory, since Polars would otherwise convert (i.e., copy) 
+        every string column of a mapped file; the file is therefore somewhat larger than with plain strings.
+        '''
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        
+        if compression not in NIBRSDataset.arrow_compressions:
+            raise ValueError(f"Invalid compression: only {', '.join(NIBRSDataset.arrow_compressions)} are allowed.")
+        
+        parquet_file = Path(parquet_file)
+        out_file = parquet_file.with_suffix(".arrow")
+        tmp_file = out_file.with_name(f".{out_file.name}.tmp")
+        
+        source = pq.ParquetFile(parquet_file)
+        to_arrow = lambda table: pl.from_arrow(table).to_arrow(compat_level = pl.CompatLevel.newest())
+        schema = to_arrow(source.schema_arrow.empty_table()).schema.with_metadata({
+            **(source.schema_arrow.metadata or {}), b"nibrs_arrow_compression": compression.encode()
+            })
+        options = pa.ipc.IpcWriteOptions(compression = None if compression == "uncompressed" else compression)
+        
+        with pa.ipc.new_file(str(tmp_file), schema, options = options) as writer:
+            for record_batch in source.iter_batches(batch_size = batch_size):
+                writer.write_table(to_arrow(record_batch).cast(schema))
+        
+        tmp_file.replace(out_file)
+        
+        return out_file
+    
+    def cache_as_arrow(self, compression: str = "uncompressed") -> list:
+        '''
+        Converts every local .parquet file of the dataset to .arrow (see convert_to_arrow), so that later instances 
+        read the .arrow files instead. Returns the written files.
+        '''
+        if self.is_remote:
+            raise ValueError("Only local sources can be cached as .arrow files.")
+        
+        out_files = []
+        for key, paths in self.files.items():
+            if paths[0].endswith(".parquet"):
+                out_files.append(NIBRSDataset.convert_to_arrow(paths[0], compression))
+                self.files[key] = [str(out_files[-1])]
+        
+        return out_files
+    
+    @property
+    def segments(self) -> list:
+        return sorted({segment_name for segment_name, _ in self.files})
+    
+    @property
+    def years(self) -> list:
+        return sorted({year for _, year in self.files})
+    
+    def scan_segment(self, segment_name: str, years: list = None) -> pl.LazyFrame:
+        '''
+        years: Years to include, defaulting to all.
+        
+        Returns segment_name across years as one LazyFrame with a data_year column. Column types are relaxed to 
+        a common supertype because pandas infers them per master file.
+        '''
+        paths = {year: year_paths for (segment, year), year_paths in self.files.items()
+                 if segment == segment_name and (years is None or year in map(str, years))}
+        
+        if not paths:
+            raise KeyError(f"No {segment_name} files found in {self.source} for years {years or self.years}.")
+        
+        scans = [
+            self._scan_file(year_paths).with_columns(data_year = pl.lit(year))
+            for year, year_paths in paths.items()
+        ]
+        
+        return pl.concat(scans, how = "diagonal_relaxed")
+    
+    @staticmethod
+    def join_segments(left: pl.LazyFrame, right: pl.LazyFrame, how: str = "inner", suffix: str = "_right") -> pl.LazyFrame:
+        '''
+        Joins two segments at the incident level, i.e., on (data_year, ori, incident_number).
+        '''
+        return left.join(right, on = NIBRSDataset.key_columns, how = how, suffix = suffix)
+    
+    def incidents(self, segment_name: str = None, years: list = None, how: str = "left") -> pl.LazyFrame:
+        '''
+        segment_name: Segment to join onto the administrative segment (e.g., offense_segment). If not specified, only the
+        administrative segment is returned.
+        
+        Returns the administrative segment joined with segment_name. Columns that every segment repeats (segment_level, 
+        state_code, incident_date) are kept once, and the remaining name clashes (e.g., db_id) get a _${segment_name} suffix.
+        
+        Every segment other than the administrative segment has many records per incident, so only one is joined per call:
+        joining, say, offenses and victims would return every (offense, victim) pair of each incident. To combine several,
+        aggregate each of them per incident first (see core/features.py) and join the results with join_segments.
+        '''
+        out_table = self.scan_segment("administrative_segment", years)
+        
+        if segment_name is None:
+            return out_table
+        if not isinstance(segment_name, str):
+            raise TypeError(f"segment_name must be a single segment name, not {type(segment_name).__name__}.")
+        
+        right = self.scan_segment(segment_name, years)
+        right = right.drop([column for column in NIBRSDataset.shared_columns if column in right.collect_schema().names()])
+        
+        return NIBRSDataset.join_segments(out_table, right, how = how, suffix = f"_{segment_name}")
+    
+    @staticmethod
+    def collect(query: pl.LazyFrame) -> pl.DataFrame:
+        return query.collect(streaming = True)
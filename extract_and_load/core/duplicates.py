@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import polars as pl
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from . import general
+
+if TYPE_CHECKING:
+    from pyarrow.fs import FileSystem
+
+# https://arrow.apache.org/docs/python/parquet.html#reading-parquet-files-in-batches
+# https://arrow.apache.org/docs/python/ipc.html
+
+class DuplicateFinder:
+    spill_schema = pa.schema([
+        ("key_hash", pa.uint64()),
+        ("content_hash1", pa.uint64()),
+        ("content_hash2", pa.uint64()),
+        ("source_file", pa.string()),
+        ("db_id", pa.string())
+    ])
+
+    def __init__(self,
+                 natural_key: list,
+                 spill_dir: Path,
+                 n_partitions: int = 64,
+                 batch_size: int = 250_000,
+                 ignore_columns: tuple = ("db_id",)):
+        '''
+        natural_key: Columns that identify a record regardless of master file (see natural_keys in col_specs.yml).
+        spill_dir: Directory for the partitioned spill files. It must not be shared with another instance.
+        n_partitions: Number of spill files. Peak memory is about one batch plus 1 / n_partitions of all hashes.
+        batch_size: Number of rows read from a .parquet file at a time.
+        ignore_columns: Columns excluded from the content hash because they differ between otherwise identical
+        records (e.g., db_id, which encodes the year and row number).
+
+        Streams .parquet segments one batch at a time, hashes each row's natural key and content (two independent
+        64-bit hashes, i.e., 128 bits), and appends the hashes to the spill file of partition key_hash % n_partitions.
+        Rows with the same natural key, and therefore all exact duplicates, land in the same partition, so each
+        partition can be checked on its own.
+        '''
+        self.natural_key = list(natural_key)
+        self.spill_dir = Path(spill_dir)
+        self.n_partitions = n_partitions
+        self.batch_size = batch_size
+        self.ignore_columns = set(ignore_columns)
+
+        self.spill_dir.mkdir(parents = True, exist_ok = True)
+        self._writers = {}
+
+    def _spill_file(self, partition: int) -> Path:
+        return self.spill_dir.joinpath(f"partition-{partition:04d}.arrow")
+
+    def _get_writer(self, partition: int) -> pa.ipc.RecordBatchStreamWriter:
+        if partition not in self._writers:
+            self._writers[partition] = pa.ipc.new_stream(str(self._spill_file(partition)), DuplicateFinder.spill_schema)
+
+        return self._writers[partition]
+
+    @staticmethod
+    def _canonicalize(batch: pl.DataFrame) -> pl.DataFrame:
+        '''
+        Casts every column to a canonical string (see general.canonicalize_value). pandas infers column types per
+        master file, so 04, 4, and 4.0 must hash the same across years.
+        '''
+        return batch.select(general.canonicalize_value(pl.col(name)) for name in batch.columns)
+
+    def add_parquet_file(self, path: str, filesystem: FileSystem = None) -> int:
+        '''
+        path: Local path, or bucket_name/object_name if filesystem is specified.
+        filesystem: e.g., AmazonS3().create_pyarrow_filesystem() to stream from an S3 bucket.
+
+        Hashes every row of path into the spill files. Returns the number of rows read.
+        '''
+        source = filesystem.open_input_file(path) if filesystem else path
+        parquet_file = pq.ParquetFile(source)
+        source_file = Path(path).name
+        n_rows = 0
+
+        missing_columns = set(self.natural_key) - set(parquet_file.schema_arrow.names)
+        if missing_columns:
+            raise KeyError(f"{source_file} has no {', '.join(sorted(missing_columns))} column(s).")
+
+        for record_batch in parquet_file.iter_batches(batch_size = self.batch_size):
+            batch = pl.from_arrow(record_batch)
+            content_columns = sorted(name for name in batch.columns if name not in self.ignore_columns)
+            canonical = DuplicateFinder._canonicalize(batch.select(content_columns))
+
+            hashes = pl.DataFrame({
+                "key_hash": canonical.select(self.natural_key).hash_rows(seed = 0),
+                "content_hash1": canonical.hash_rows(seed = 1),
+                "content_hash2": canonical.hash_rows(seed = 2),
+                "source_file": pl.Series([source_file] * batch.height, dtype = pl.Utf8),
+                "db_id": (batch["db_id"].cast(pl.Utf8) if "db_id" in batch.columns
+                          else pl.int_range(n_rows, n_rows + batch.height, eager = True).cast(pl.Utf8))
+            }).with_columns(partition = pl.col("key_hash") % self.n_partitions)
+
+            for (partition,), rows in hashes.partition_by("partition", as_dict = True, include_key = False).items():
+                self._get_writer(partition).write_table(rows.to_arrow().cast(DuplicateFinder.spill_schema))
+
+            n_rows += batch.height
+
+        return n_rows
+
+    def close(self) -> None:
+        for writer in self._writers.values():
+            writer.close()
+
+        self._writers = {}
+
+    def find_duplicates(self) -> pl.DataFrame:
+        '''
+        Loads one spill file at a time and returns every row that is either an exact duplicate (same content) or
+        conflicting (same natural key, different content), along with the group it belongs to.
+        '''
+        self.close()
+
+        out_tables = []
+        for spill_file in sorted(self.spill_dir.glob("partition-*.arrow")):
+            with pa.ipc.open_stream(str(spill_file)) as reader:
+                partition = pl.from_arrow(reader.read_all())
+
+            exact_duplicates = (
+                partition
+                .filter(pl.len().over("content_hash1", "content_hash2") > 1)
+                .with_columns(
+                    duplicate_type = pl.lit("exact"),
+                    group_id = pl.concat_str(pl.col("content_hash1").cast(pl.Utf8), pl.col("content_hash2").cast(pl.Utf8), separator = "-")
+                    )
+                )
+            conflicting = (
+                partition
+                .filter(pl.struct("content_hash1", "content_hash2").n_unique().over("key_hash") > 1)
+                .with_columns(duplicate_type = pl.lit("conflicting"), group_id = pl.col("key_hash").cast(pl.Utf8))
+                )
+
+            out_tables.append(
+                pl.concat([exact_duplicates, conflicting]).select("duplicate_type", "group_id", "source_file", "db_id")
+                )
+
+        if not out_tables:
+            return pl.DataFrame(schema = {"duplicate_type": pl.Utf8, "group_id": pl.Utf8, "source_file": pl.Utf8, "db_id": pl.Utf8})
+
+        return pl.concat(out_tables).sort("duplicate_type", "group_id", "source_file", "db_id")
+
+    def cleanup(self) -> None:
+        self.close()
+
+        for spill_file in self.spill_dir.glob("partition-*.arrow"):
+            spill_file.unlink()
+        
+        if not any(self.spill_dir.iterdir()):
+            self.spill_dir.rmdir()
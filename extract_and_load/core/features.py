@@ -0,0 +1,218 @@
+from __future__ import annotations
+
+import json
+
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import polars as pl
+
+from . import general
+
+if TYPE_CHECKING:
+    from .dataset import NIBRSDataset
+
+# Group A larceny/theft offenses, as listed in archive/nibrs_codes.yml.
+LARCENY_OFFENSE_CODES = ["23A", "23B", "23C", "23D", "23E", "23F", "23G", "23H"]
+
+# NIBRS Technical Specification: exceptional clearance codes A-E (N = not applicable), and victim-to-offender
+# relationships ST (stranger) and RU (relationship unknown).
+EXCEPTIONAL_CLEARANCE_CODES = ["A", "B", "C", "D", "E"]
+UNKNOWN_RELATIONSHIP_CODES = ["ST", "RU"]
+
+class LarcenyFeatureBuilder:
+    segments = ["administrative_segment", "offense_segment", "victim_segment", "arrestee_segment"]
+    manifest_name = "larceny_features_manifest.json"
+
+    def __init__(self, dataset: NIBRSDataset, output_dir: Path):
+        '''
+        dataset: Decoded segments to build features from.
+        output_dir: Directory for larceny_features_${year}.parquet and the manifest of what each year was built from.
+
+        Builds one typed row per larceny incident: incident-level covariates from the administrative, offense, and
+        victim segments, plus clearance labels from the arrestee segment and administrative clearance fields.
+        Offenses are filtered to larceny first, and every other segment is reduced to those incidents before it is
+        aggregated, so the joins stay small and run on the streaming engine.
+        '''
+        self.dataset = dataset
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents = True, exist_ok = True)
+
+    @staticmethod
+    def _to_str(column: str) -> pl.Expr:
+        '''
+        pandas infers column types per master file (e.g., 20220115.0 in a column with missing values), so values are
+        canonicalized (see general.canonicalize_value) before they are parsed as dates, integers, or codes.
+        '''
+        return general.canonicalize_value(pl.col(column))
+
+    @staticmethod
+    def _to_int(column: str, dtype: pl.DataType = pl.Int16) -> pl.Expr:
+        '''
+        Some numeric fields carry codes (e.g., age_of_victim = NB), so values are parsed from strings and anything
+        non-numeric becomes null.
+        '''
+        return LarcenyFeatureBuilder._to_str(column).cast(dtype, strict = False)
+
+    def _larceny_offenses(self, year: str) -> pl.LazyFrame:
+        return (
+            self.dataset.scan_segment("offense_segment", [year])
+            .with_columns(LarcenyFeatureBuilder._to_str("ucr_offense_code"))
+            .group_by(self.dataset.key_columns)
+            .agg(
+                n_offenses = pl.len().cast(pl.UInt16),
+                is_larceny = pl.col("ucr_offense_code").is_in(LARCENY_OFFENSE_CODES).any(),
+                larceny_offense_code = pl.col("ucr_offense_code").filter(pl.col("ucr_offense_code").is_in(LARCENY_OFFENSE_CODES)).min(),
+                location_type = LarcenyFeatureBuilder._to_str("location_type").filter(pl.col("ucr_offense_code").is_in(LARCENY_OFFENSE_CODES)).first(),
+                attempted = (LarcenyFeatureBuilder._to_str("offense_attempted_or_completed") == "A").any()
+            )
+            .filter(pl.col("is_larceny"))
+            .drop("is_larceny")
+        )
+
+    def _victims(self, year: str, incidents: pl.LazyFrame) -> pl.LazyFrame:
+        relationships = [f"victim_relationship_to_offender{i}" for i in range(1, 11)]
+        relationship_known = pl.any_horizontal(
+            LarcenyFeatureBuilder._to_str(column).is_not_null() & ~LarcenyFeatureBuilder._to_str(column).is_in(UNKNOWN_RELATIONSHIP_CODES)
+            for column in relationships
+        )
+
+        return (
+            self.dataset.scan_segment("victim_segment", [year])
+            .join(incidents, on = self.dataset.key_columns, how = "semi")
+            .with_columns(
+                age = LarcenyFeatureBuilder._to_int("age_of_victim"),
+                relationship_known = relationship_known,
+                is_individual = LarcenyFeatureBuilder._to_str("type_of_victim") == "I",
+                is_business = LarcenyFeatureBuilder._to_str("type_of_victim") == "B"
+            )
+            .group_by(self.dataset.key_columns)
+            .agg(
+                n_victims = pl.len().cast(pl.UInt16),
+                n_individual_victims = pl.col("is_individual").sum().cast(pl.UInt16),
+                has_business_victim = pl.col("is_business").any(),
+                mean_victim_age = pl.col("age").mean().cast(pl.Float32),
+                victim_knows_offender = pl.col("relationship_known").any()
+            )
+        )
+
+    def _arrestees(self, year: str, incidents: pl.LazyFrame) -> pl.LazyFrame:
+        return (
+            self.dataset.scan_segment("arrestee_segment", [year])
+            .join(incidents, on = self.dataset.key_columns, how = "semi")
+            .group_by(self.dataset.key_columns)
+            .agg(n_arrestees = pl.len().cast(pl.UInt16))
+        )
+
+    def build_query(self, year: str) -> pl.LazyFrame:
+        offenses = self._larceny_offenses(year)
+        incidents = offenses.select(self.dataset.key_columns)
+
+        incident_date = LarcenyFeatureBuilder._to_str("incident_date").str.strptime(pl.Date, "%Y%m%d", strict = False)
+
+        return (
+            self.dataset.scan_segment("administrative_segment", [year])
+            .join(offenses, on = self.dataset.key_columns, how = "inner")
+            .join(self._victims(year, incidents), on = self.dataset.key_columns, how = "left")
+            .join(self._arrestees(year, incidents), on = self.dataset.key_columns, how = "left")
+            .with_columns(
+                incident_date = incident_date,
+                cleared_exceptionally = LarcenyFeatureBuilder._to_str("cleared_exceptionally").is_in(EXCEPTIONAL_CLEARANCE_CODES),
+                n_arrestees = pl.col("n_arrestees").fill_null(0)
+            )
+            .select(
+                pl.col("data_year").cast(pl.Int16),
+                pl.col("state_code").cast(pl.Utf8).cast(pl.Categorical),
+                pl.col("ori").cast(pl.Utf8),
+                pl.col("incident_number").cast(pl.Utf8),
+                pl.col("incident_date"),
+                pl.col("incident_date").dt.month().cast(pl.Int8).alias("incident_month"),
+                pl.col("incident_date").dt.weekday().cast(pl.Int8).alias("incident_weekday"),
+                LarcenyFeatureBuilder._to_int("incident_date_hour", pl.Int8).alias("incident_hour"),
+                pl.col("larceny_offense_code").cast(pl.Categorical),
+                pl.col("location_type").cast(pl.Categorical),
+                pl.col("n_offenses"),
+                pl.col("attempted"),
+                pl.col("n_victims").fill_null(0),
+                pl.col("n_individual_victims").fill_null(0),
+                pl.col("has_business_victim").fill_null(False),
+                pl.col("mean_victim_age"),
+                pl.col("victim_knows_offender").fill_null(False),
+                pl.col("n_arrestees"),
+                (pl.col("n_arrestees") > 0).alias("cleared_by_arrest"),
+                pl.col("cleared_exceptionally"),
+                ((pl.col("n_arrestees") > 0) | pl.col("cleared_exceptionally")).alias("cleared")
+            )
+        )
+
+    def _output_file(self, year: str) -> Path:
+        return self.output_dir.joinpath(f"larceny_features_{year}.parquet")
+
+    def _fingerprint(self, year: str) -> dict:
+        '''
+        Identifies the inputs of year: modification time and size of local files, or the paths of remote files along
+        with the ETag of the decoded object they come from, which changes whenever the year is uploaded again.
+        '''
+        fingerprint = {}
+        for segment_name in LarcenyFeatureBuilder.segments:
+            paths = self.dataset.files[(segment_name, year)]
+            if self.dataset.is_remote:
+                etag = self.dataset.etags.get((segment_name, year))
+                fingerprint[segment_name] = [f"{path}:{etag}" for path in paths]
+            else:
+                fingerprint[segment_name] = []
+                for path in paths:
+                    stat = Path(path).stat()
+                    fingerprint[segment_name].append(f"{path}:{stat.st_size}:{stat.st_mtime_ns}")
+
+        return fingerprint
+
+    def _load_manifest(self) -> dict:
+        manifest_file = self.output_dir.joinpath(LarcenyFeatureBuilder.manifest_name)
+
+        return json.loads(manifest_file.read_text()) if manifest_file.exists() else {}
+
+    def build(self, years: list = None, force: bool = False) -> list:
+        '''
+        years: Years to consider, defaulting to every year with all four segments.
+        force: If True, years are rebuilt even if their inputs are unchanged.
+
+        Writes larceny_features_${year}.parquet for each year whose inputs changed since it was last built.
+        Returns the rebuilt years.
+        '''
+        available_years = [
+            year for year in self.dataset.years
+            if all((segment_name, year) in self.dataset.files for segment_name in LarcenyFeatureBuilder.segments)
+            ]
+        years = [str(year) for year in years] if years else available_years
+
+        missing_years = set(years) - set(available_years)
+        if missing_years:
+            raise KeyError(f"Not all segments are decoded for {', '.join(sorted(missing_years))}.")
+
+        manifest = self._load_manifest()
+        rebuilt_years = []
+
+        for year in years:
+            fingerprint = self._fingerprint(year)
+
+            if not force and manifest.get(year) == fingerprint and self._output_file(year).exists():
+                continue
+
+            query = self.build_query(year)
+            try:
+                query.sink_parquet(self._output_file(year))
+            except pl.exceptions.InvalidOperationError:
+                # Not every plan can be sunk by the streaming engine; fall back to a streaming collect.
+                query.collect(streaming = True).write_parquet(self._output_file(year))
+
+            n_rows, n_dates = pl.scan_parquet(self._output_file(year)).select(pl.len(), pl.col("incident_date").count()).collect().row(0)
+            if n_rows and not n_dates:
+                self._output_file(year).unlink()
+                raise ValueError(f"No incident_date of {year} could be parsed as %Y%m%d; check the decoded administrative segment.")
+
+            manifest[year] = fingerprint
+            self.output_dir.joinpath(LarcenyFeatureBuilder.manifest_name).write_text(json.dumps(manifest, indent = 2))
+            rebuilt_years.append(year)
+
+        return rebuilt_years
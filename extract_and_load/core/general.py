@@ -1,12 +1,25 @@
+from __future__ import annotations
+
 import logging
+import re
 import yaml
 
 from pathlib import Path
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import polars as pl
+
+# pandas infers column types per master file, so the same field can be decoded as 04, 4, or 4.0. Each pattern is 
+# replaced by its first group, in order: integral floats lose their fractional part (a column with missing values 
+# becomes float), then integers lose their leading zeros.
+INFERRED_VALUE_PATTERNS = [r"^(-?[0-9]+)\.0+$", r"^0+([0-9]+)$"]
 
 def create_logger(log_file: Path, name: str = "LOGS", level: int = logging.DEBUG) -> logging.Logger:
     log_file = Path(log_file)
     logger = logging.getLogger(name)
     logger.setLevel(level)  
+    logger.handlers.clear() # avoid duplicate handlers when a long-lived process (e.g., a pool worker) calls this again
     file_handler = logging.FileHandler(log_file, mode = "w")
     console_handler = logging.StreamHandler()
 
@@ -40,3 +53,31 @@ def create_output_dir(output_dir_str: str, log_file: str) -> tuple:
     logger = create_logger(log_file = logs_dir.joinpath(log_file))
     
     return output_dir, logger
+
+def find_years(raw_data_dir: Path) -> list:
+    '''
+    Returns the years of all master files of form nibrs-${year}.zip in raw_data_dir, as Makefile does.
+    '''
+    matches = (re.fullmatch(r"nibrs-([0-9]{4})\.zip", file.name) for file in Path(raw_data_dir).iterdir())
+    
+    return [match.group(1) for match in matches if match]
+
+def canonicalize_value(column: pl.Expr) -> pl.Expr:
+    '''
+    Returns column as a trimmed string with INFERRED_VALUE_PATTERNS applied, so that values compare equal however
+    pandas inferred them. canonicalize_value_sql is the same in SQL.
+    '''
+    import polars as pl
+    
+    value = column.cast(pl.Utf8).str.strip_chars()
+    for pattern in INFERRED_VALUE_PATTERNS:
+        value = value.str.replace(pattern, "${1}")
+    
+    return value
+
+def canonicalize_value_sql(column: str) -> str:
+    value = f"trim({column})"
+    for pattern in INFERRED_VALUE_PATTERNS:
+        value = f"regexp_replace({value}, '{pattern}', '\\1')"
+    
+    return value
@@ -1,8 +1,20 @@
-import pandas as pd
+from __future__ import annotations
 
+import json
+import shutil
+
+from collections import Counter
 from io import StringIO
 from pathlib import Path
-from zipfile_deflate64 import ZipFile
+from typing import TYPE_CHECKING, Callable, Iterator
+
+# pandas, polars, and zipfile_deflate64 are imported where they are used, so that unzipping does not load
+# pandas and decoding does not load zipfile_deflate64.
+if TYPE_CHECKING:
+    import pandas as pd
+    import polars as pl
+    
+    from .profiling import SegmentProfile
 
 class NIBRSUnzip:
     def __init__(self, zip_file: Path):
@@ -18,6 +30,8 @@ class NIBRSUnzip:
         '''
         Returns the file name of the underlying ASCII file in zip_file. No other file should be present in zip_file.
         '''
+        from zipfile_deflate64 import ZipFile
+        
         with ZipFile(self.zip_file, "r") as z:
             contents = z.namelist()
             
@@ -49,6 +63,8 @@ class NIBRSUnzip:
             raise FileNotFoundError(f"No {ascii_file} found.")
 
     def unzip(self, standardize: bool = True) -> None:
+        from zipfile_deflate64 import ZipFile
+        
         with ZipFile(self.zip_file, "r") as z:
             z.extractall(path = (self.zip_file).parent)
             print(f"{self.zip_file} has been unzipped.")    
@@ -57,11 +73,20 @@ class NIBRSUnzip:
             self._standardize()
 
 class NIBRSDecoder:
-    def __init__(self, nibrs_master_file: str, col_specs: dict):
+    def __init__(self, 
+                 nibrs_master_file: str, 
+                 col_specs: dict, 
+                 states: list = None, 
+                 oris: list = None, 
+                 columns: list = None):
         '''
         nibrs_master_file: Path to NIBRS master file (.txt).
         col_specs: A dictionary that defines the segment names' levels, along with their
         column widths and column names.
+        states: If specified, only records with these state codes (e.g., ["IL", "WI"]) are decoded.
+        oris: If specified, only records of these agencies are decoded.
+        columns: If specified, only these columns are decoded, along with segment_level, ori, incident_number, 
+        and the segment's natural_keys in col_specs (if any).
         
         ------------------- col_specs example (as a .yml file)
             segment_level_codes:
@@ -74,9 +99,15 @@ class NIBRSDecoder:
         
         In NIBRS, the segment "level" (a 2-character alphanumeric sequence) is how we can delineate which lines 
         belong to which segment. For example, all lines that begin with "01" are the so-called Administrative Segment.
+        Likewise, state_code and ori sit at fixed positions, so states and oris are applied to the raw lines before 
+        any of them is parsed. Decoded rows keep the index they would have in the unfiltered segment, so db_ids of 
+        a filtered extract match those of a full decode. Similarly, read_fwf only slices the requested columns.
         '''
         self.nibrs_master_file = nibrs_master_file
         self.col_specs = col_specs
+        self.states = sorted({state.upper() for state in states}) if states else None
+        self.oris = sorted({ori.upper() for ori in oris}) if oris else None
+        self.columns = list(columns) if columns else None
         
         if "segment_level_codes" not in self.col_specs.keys():
             raise KeyError("Invalid col_specs. It must have a segment_level_codes key.")
@@ -91,28 +122,426 @@ class NIBRSDecoder:
         except KeyError:
             raise KeyError("no code for {segment_name} found in col_specs")
         
+    def get_selected_col_specs(self, segment_name: str) -> dict:
+        '''
+        Returns col_specs[segment_name], restricted to the requested columns (see columns) if any, in col_specs order.
+        '''
+        segment_col_specs = self.col_specs[segment_name]
+        
+        if self.columns is None:
+            return segment_col_specs
+        
+        missing_columns = set(self.columns) - set(segment_col_specs)
+        if missing_columns:
+            raise KeyError(f"{segment_name} has no {', '.join(sorted(missing_columns))} column(s).")
+        
+        selected_columns = {
+            "segment_level", "ori", "incident_number", 
+            *self.col_specs.get("natural_keys", {}).get(segment_name, []), 
+            *self.columns
+            }
+        
+        return {name: col_spec for name, col_spec in segment_col_specs.items() if name in selected_columns}
+    
     def get_col_specs_for_segment(self, segment_name: str) -> tuple:
-        col_specs_config = self.col_specs[segment_name]
+        col_specs_config = self.get_selected_col_specs(segment_name)
         
         return tuple(tuple(i) for i in col_specs_config.values())
     
     def get_col_names_for_segment(self, segment_name: str) -> list:
-        return list(self.col_specs[segment_name].keys())
+        return list(self.get_selected_col_specs(segment_name).keys())
+    
+    def _get_record_filter(self, segment_name: str, binary: bool = False) -> Callable:
+        '''
+        binary: If True, the returned function is applied to lines read as bytes.
+        
+        Returns a function that tells whether a line of segment_name belongs to the requested states and oris by 
+        comparing its state_code and ori slices, or None if neither was requested.
+        '''
+        if not self.states and not self.oris:
+            return None
+        
+        state_start, state_end = self.col_specs[segment_name]["state_code"]
+        ori_start, ori_end = self.col_specs[segment_name]["ori"]
+        
+        encode = (lambda value: value.encode()) if binary else (lambda value: value)
+        states = {encode(state.ljust(state_end - state_start)) for state in self.states} if self.states else None
+        oris = {encode(ori.ljust(ori_end - ori_start)) for ori in self.oris} if self.oris else None
+        
+        def is_selected(line) -> bool:
+            return ((states is None or line[state_start:state_end] in states) 
+                    and (oris is None or line[ori_start:ori_end] in oris))
+        
+        return is_selected
+    
+    @staticmethod
+    def _select_records(lines: Iterator, is_selected: Callable, ordinals: list) -> Iterator:
+        '''
+        Yields the lines that pass is_selected and appends their position among lines to ordinals.
+        '''
+        for ordinal, line in enumerate(lines):
+            if is_selected(line):
+                ordinals.append(ordinal)
+                yield line
     
-    def decode_segment(self, segment_name: str) -> pd.DataFrame:
+    def _parse_segment_text(self, segment_name: str, segment_as_text: StringIO) -> pd.DataFrame:
+        '''
+        segment_as_text: Fixed-length lines that all belong to segment_name.
+        
+        Every column is read as a string rather than inferred by pandas, so the full, batched, checkpointed, and indexed
+        routes decode the same values (e.g., 01 rather than 1, 20220115 rather than 20220115.0) with the same schema.
+        '''
+        import pandas as pd
+        
+        segment_as_text.seek(0) # reset the pointer to the very beginning
+        
+        return pd.read_fwf(segment_as_text, 
+                           colspecs = self.get_col_specs_for_segment(segment_name), 
+                           names = self.get_col_names_for_segment(segment_name),
+                           dtype = str)
+    
+    def decode_segment(self, segment_name: str, profile: SegmentProfile = None) -> pd.DataFrame:
+        '''
+        profile: If specified, record lengths are counted while the master file is streamed, and the remaining
+        metrics are computed from the decoded table, so profiling costs no extra scan of the master file.
+        '''
         segment_code = self._get_code_for_segment(segment_name)
-        col_specs = self.get_col_specs_for_segment(segment_name)
-        col_names = self.get_col_names_for_segment(segment_name)
+        is_selected = self._get_record_filter(segment_name)
+        ordinals = []
         
         with open(self.nibrs_master_file, "r") as file:
             filtered_lines = (line for line in file if line.startswith(segment_code))
+            if is_selected is not None:
+                filtered_lines = NIBRSDecoder._select_records(filtered_lines, is_selected, ordinals)
             
             segment_as_text = StringIO()
-            for line in filtered_lines:
-                segment_as_text.write(line)
-            
-            segment_as_text.seek(0) # reset the pointer to the very beginning
+            if profile is None:
+                for line in filtered_lines:
+                    segment_as_text.write(line)
+            else:
+                for line in filtered_lines:
+                    segment_as_text.write(line)
+                    profile.add_record_length(len(line.rstrip("\r\n")))
             
-            out_table = pd.read_fwf(segment_as_text, colspecs = col_specs, names = col_names)
+            out_table = self._parse_segment_text(segment_name, segment_as_text)
+        
+        if is_selected is not None:
+            out_table.index = ordinals
+        
+        if profile is not None:
+            profile.update(out_table)
 
         return out_table
+    
+    def iter_segment_batches(self, 
+                             segment_name: str, 
+                             batch_size: int = 500_000, 
+                             profile: SegmentProfile = None) -> Iterator[pd.DataFrame]:
+        '''
+        batch_size: Maximum number of lines decoded at a time.
+        profile: See decode_segment.
+        
+        Yields segment_name in batches of at most batch_size rows, so that memory stays bounded by one batch. 
+        Each batch's index continues where the previous one ended, as if the whole segment had been decoded 
+        at once.
+        '''
+        segment_code = self._get_code_for_segment(segment_name)
+        is_selected = self._get_record_filter(segment_name)
+        
+        with open(self.nibrs_master_file, "r") as file:
+            segment_as_text, ordinals = StringIO(), []
+            
+            for ordinal, line in enumerate(line for line in file if line.startswith(segment_code)):
+                if is_selected is not None and not is_selected(line):
+                    continue
+                
+                segment_as_text.write(line)
+                ordinals.append(ordinal)
+                if profile is not None:
+                    profile.add_record_length(len(line.rstrip("\r\n")))
+                
+                if len(ordinals) == batch_size:
+                    yield self._decode_batch(segment_name, segment_as_text, ordinals, profile)
+                    segment_as_text, ordinals = StringIO(), []
+            
+            if ordinals:
+                yield self._decode_batch(segment_name, segment_as_text, ordinals, profile)
+    
+    def _decode_batch(self, segment_name: str, segment_as_text: StringIO, ordinals: list, profile: SegmentProfile = None) -> pd.DataFrame:
+        '''
+        ordinals: Position of each line within the segment, which becomes the index of the batch.
+        '''
+        out_table = self._parse_segment_text(segment_name, segment_as_text)
+        out_table.index = ordinals
+        
+        if profile is not None:
+            profile.update(out_table)
+        
+        return out_table
+    
+    def _read_checkpoint(self, checkpoint_file: Path, master_file_state: dict) -> dict:
+        '''
+        Returns the checkpoint in checkpoint_file if it was written for the same master file, segment, and chunk size 
+        and all its parts exist; otherwise, a fresh checkpoint.
+        '''
+        fresh_checkpoint = {**master_file_state, "chunks": []}
+        
+        if not checkpoint_file.exists():
+            return fresh_checkpoint
+        
+        checkpoint = json.loads(checkpoint_file.read_text())
+        parts_exist = all(checkpoint_file.parent.joinpath(chunk["part"]).exists() 
+                          for chunk in checkpoint["chunks"] if chunk["part"])
+        
+        if {key: checkpoint.get(key) for key in master_file_state} != master_file_state or not parts_exist:
+            return fresh_checkpoint
+        
+        return checkpoint
+    
+    @staticmethod
+    def _write_atomically(path: Path, write: Callable) -> None:
+        '''
+        write: Function that writes to the path it is given.
+        
+        Writes to a temporary file, then renames it to path, so that path is either complete or absent.
+        '''
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        write(tmp_path)
+        tmp_path.replace(path)
+    
+    def decode_segment_checkpointed(self, 
+                                    segment_name: str, 
+                                    out_file: Path, 
+                                    db_id_prefix: str, 
+                                    chunk_bytes: int = 256 * 1024 ** 2, 
+                                    profile: SegmentProfile = None) -> Path:
+        '''
+        out_file: Path of the final .parquet file.
+        db_id_prefix: Prefix of the db_id column, as in decode.py (e.g., 2022_).
+        chunk_bytes: Size of the byte ranges of the master file that are decoded and committed at a time. A chunk 
+        ends at the first line break after chunk_bytes, so chunk boundaries (and, therefore, the output) only 
+        depend on the master file and chunk_bytes.
+        profile: See decode_segment. Record lengths are kept in the checkpoint, so a resumed run profiles all rows.
+        
+        Decodes segment_name one chunk at a time into part files under out_file.with_suffix(".parts"), recording 
+        every committed chunk (byte range, row count, part) in a checkpoint.json next to the parts. If a run dies, 
+        the next run with the same arguments continues after the last committed chunk, with the same db_ids. 
+        Once every chunk is committed, the parts are concatenated into out_file and the parts are removed.
+        '''
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        
+        out_file = Path(out_file)
+        parts_dir = out_file.with_suffix(".parts")
+        parts_dir.mkdir(parents = True, exist_ok = True)
+        checkpoint_file = parts_dir.joinpath("checkpoint.json")
+        
+        master_file = Path(self.nibrs_master_file)
+        master_file_state = {
+            "master_file": master_file.name, 
+            "size": master_file.stat().st_size, 
+            "mtime_ns": master_file.stat().st_mtime_ns,
+            "segment_name": segment_name, 
+            "chunk_bytes": chunk_bytes,
+            "db_id_prefix": db_id_prefix,
+            "states": self.states,
+            "oris": self.oris,
+            "columns": self.columns
+        }
+        checkpoint = self._read_checkpoint(checkpoint_file, master_file_state)
+        
+        segment_code = self._get_code_for_segment(segment_name).encode()
+        is_selected = self._get_record_filter(segment_name, binary = True)
+        schema = pa.schema([(name, pa.string()) for name in self.get_col_names_for_segment(segment_name) + ["db_id"]])
+        
+        offset = checkpoint["chunks"][-1]["end"] if checkpoint["chunks"] else 0
+        n_rows = sum(chunk["n_rows"] for chunk in checkpoint["chunks"])
+        
+        with open(master_file, "rb") as file:
+            while offset < master_file_state["size"]:
+                file.seek(offset)
+                chunk = file.read(chunk_bytes) + file.readline() # finish the line the chunk ends in
+                
+                segment_as_text, record_lengths, ordinals = StringIO(), Counter(), []
+                chunk_rows = 0 # records of the segment, selected or not, so that db_ids do not depend on states and oris
+                
+                for line in chunk.splitlines():
+                    if not line.startswith(segment_code):
+                        continue
+                    
+                    if is_selected is None or is_selected(line):
+                        line = line.decode()
+                        segment_as_text.write(line + "\n")
+                        record_lengths[len(line)] += 1
+                        ordinals.append(chunk_rows)
+                    
+                    chunk_rows += 1
+                
+                part = None
+                
+                if ordinals:
+                    out_table = self._parse_segment_text(segment_name, segment_as_text)
+                    out_table.index = ordinals
+                    out_table["db_id"] = db_id_prefix + (out_table.index + n_rows + 1).astype(str)
+                    
+                    part = f"part-{len(checkpoint['chunks']):05d}.parquet"
+                    NIBRSDecoder._write_atomically(
+                        parts_dir.joinpath(part), 
+                        lambda path: pq.write_table(pa.Table.from_pandas(out_table, schema = schema, preserve_index = False), path)
+                        )
+                
+                checkpoint["chunks"].append({
+                    "start": offset, "end": offset + len(chunk), "n_rows": chunk_rows, "part": part, 
+                    "record_lengths": {str(length): count for length, count in record_lengths.items()}
+                })
+                NIBRSDecoder._write_atomically(checkpoint_file, lambda path: path.write_text(json.dumps(checkpoint)))
+                
+                offset += len(chunk)
+                n_rows += chunk_rows
+        
+        def concatenate_parts(path: Path) -> None:
+            with pq.ParquetWriter(path, schema) as writer:
+                for chunk in checkpoint["chunks"]:
+                    if profile is not None:
+                        for length, count in chunk["record_lengths"].items():
+                            profile.record_lengths[int(length)] += count
+                    
+                    if chunk["part"]:
+                        part_table = pq.read_table(parts_dir.joinpath(chunk["part"]))
+                        writer.write_table(part_table)
+                        if profile is not None:
+                            profile.update(part_table.to_pandas())
+        
+        NIBRSDecoder._write_atomically(out_file, concatenate_parts)
+        shutil.rmtree(parts_dir)
+        
+        return out_file
+    
+    @property
+    def index_file(self) -> Path:
+        '''
+        Sidecar index of the master file, e.g., nibrs-2022.txt -> nibrs-2022.idx.parquet.
+        '''
+        return Path(self.nibrs_master_file).with_suffix(".idx.parquet")
+    
+    def _get_incident_key_positions(self) -> tuple:
+        '''
+        Returns the [start, end] positions of ori and incident_number, which are shared by all segments.
+        '''
+        segment_name = next(iter(self.col_specs["segment_level_codes"]))
+        
+        try:
+            return (tuple(self.col_specs[segment_name]["ori"]), 
+                    tuple(self.col_specs[segment_name]["incident_number"]))
+        except KeyError:
+            raise KeyError(f"Invalid col_specs. {segment_name} must have ori and incident_number keys.")
+    
+    def build_index(self) -> Path:
+        '''
+        Scans the master file once and writes index_file: one row per run of consecutive lines that share 
+        the same ori and incident_number, with the byte range [start, end) of that run. All segments of 
+        an incident are contiguous in the master file, so each incident maps to a single byte range.
+        '''
+        import polars as pl
+        
+        (ori_start, ori_end), (incident_start, incident_end) = self._get_incident_key_positions()
+        
+        oris, incident_numbers, starts, ends = [], [], [], []
+        current_key, offset = None, 0
+        
+        with open(self.nibrs_master_file, "rb") as file:
+            for line in file:
+                key = (line[ori_start:ori_end], line[incident_start:incident_end])
+                
+                if key != current_key:
+                    if current_key is not None:
+                        ends.append(offset)
+                    oris.append(key[0])
+                    incident_numbers.append(key[1])
+                    starts.append(offset)
+                    current_key = key
+                
+                offset += len(line)
+        
+        if current_key is not None:
+            ends.append(offset)
+        
+        index = pl.DataFrame({
+            "ori": [ori.decode().strip() for ori in oris],
+            "incident_number": [incident_number.decode().strip() for incident_number in incident_numbers],
+            "start": starts,
+            "end": ends
+        }, schema = {"ori": pl.Utf8, "incident_number": pl.Utf8, "start": pl.Int64, "end": pl.Int64})
+        
+        index.write_parquet(self.index_file)
+        
+        return self.index_file
+    
+    def _load_index(self) -> pl.DataFrame:
+        '''
+        Loads index_file, building it first if it is missing or older than the master file.
+        '''
+        import polars as pl
+        
+        index_file = self.index_file
+        
+        if not index_file.exists() or index_file.stat().st_mtime < Path(self.nibrs_master_file).stat().st_mtime:
+            self.build_index()
+        
+        return pl.read_parquet(index_file)
+    
+    def decode_records(self, segment_name: str, oris: list = None, incidents: list = None) -> pd.DataFrame:
+        '''
+        oris: Agencies whose records should be decoded.
+        incidents: (ori, incident_number) pairs whose records should be decoded.
+        
+        Decodes segment_name for the requested agencies and/or incidents only, by seeking to their byte 
+        ranges in index_file instead of scanning the whole master file. The states and oris of the decoder 
+        apply on top of these. Unlike the other routes, rows are not numbered by their position in the segment, 
+        which the skipped ranges leave unknown, so no db_id can be derived from the index of the result.
+        '''
+        import polars as pl
+        
+        if not oris and not incidents:
+            raise ValueError("At least one of oris or incidents must be specified.")
+        
+        index = self._load_index()
+        
+        condition = pl.lit(False)
+        if oris:
+            condition = condition | pl.col("ori").is_in(list(oris))
+        if incidents:
+            condition = condition | (pl.col("ori") + "|" + pl.col("incident_number")).is_in(
+                [f"{ori}|{incident_number}" for ori, incident_number in incidents]
+                )
+        
+        ranges = index.filter(condition).sort("start").select("start", "end").rows()
+        
+        segment_code = self._get_code_for_segment(segment_name).encode()
+        is_selected = self._get_record_filter(segment_name, binary = True) or (lambda line: True)
+        segment_as_text = StringIO()
+        
+        with open(self.nibrs_master_file, "rb") as file:
+            for start, end in NIBRSDecoder._merge_adjacent_ranges(ranges):
+                file.seek(start)
+                for line in file.read(end - start).splitlines():
+                    if line.startswith(segment_code) and is_selected(line):
+                        segment_as_text.write(line.decode() + "\n")
+        
+        return self._parse_segment_text(segment_name, segment_as_text)
+    
+    @staticmethod
+    def _merge_adjacent_ranges(ranges: list) -> list:
+        '''
+        ranges: Sorted (start, end) byte ranges.
+        
+        Coalesces touching ranges (e.g., consecutive incidents of the same agency) into one read.
+        '''
+        merged = []
+        for start, end in ranges:
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(end, merged[-1][1])
+            else:
+                merged.append([start, end])
+        
+        return merged
@@ -0,0 +1,162 @@
+from __future__ import annotations
+
+import base64
+
+from collections import Counter
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+# https://en.wikipedia.org/wiki/HyperLogLog
+# http://algo.inria.fr/flajolet/Publications/FlFuGaMe07.pdf
+
+class HyperLogLog:
+    def __init__(self, precision: int = 12):
+        '''
+        precision: Number of hash bits used to pick a register. The sketch has 2 ** precision one-byte registers
+        and a standard error of about 1.04 / sqrt(2 ** precision), i.e., ~1.6% at the default.
+        '''
+        if not 4 <= precision <= 16:
+            raise ValueError("Invalid precision: it must be between 4 and 16.")
+
+        self.precision = precision
+        self.registers = np.zeros(2 ** precision, dtype = np.uint8)
+
+    @staticmethod
+    def _count_leading_zeros(values: np.ndarray) -> np.ndarray:
+        '''
+        Vectorized count of leading zero bits of 64-bit unsigned integers (64 for zero).
+        '''
+        values = values.copy()
+        counts = np.zeros(values.shape, dtype = np.uint8)
+
+        for shift in (32, 16, 8, 4, 2, 1):
+            has_leading_zeros = values < (np.uint64(1) << np.uint64(64 - shift))
+            counts[has_leading_zeros] += shift
+            values[has_leading_zeros] <<= np.uint64(shift)
+
+        counts += (values >> np.uint64(63)) == 0
+
+        return counts
+
+    def add_hashes(self, hashes: np.ndarray) -> None:
+        '''
+        hashes: 64-bit hashes of the values to count.
+        '''
+        hashes = hashes.astype(np.uint64, copy = False)
+        p = np.uint64(self.precision)
+
+        register_index = (hashes >> (np.uint64(64) - p)).astype(np.int64)
+        rank = np.minimum(HyperLogLog._count_leading_zeros(hashes << p), 64 - self.precision) + 1
+
+        np.maximum.at(self.registers, register_index, rank.astype(np.uint8))
+
+    def merge(self, other: HyperLogLog) -> None:
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge sketches with different precisions.")
+
+        np.maximum(self.registers, other.registers, out = self.registers)
+
+    def estimate(self) -> int:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw_estimate = alpha * m * m / np.sum(np.power(2.0, -self.registers.astype(np.float64)))
+        empty_registers = int(np.count_nonzero(self.registers == 0))
+
+        # Small-range correction (linear counting).
+        if raw_estimate <= 2.5 * m and empty_registers > 0:
+            return int(round(m * np.log(m / empty_registers)))
+
+        return int(round(raw_estimate))
+
+    def to_base64(self) -> str:
+        return base64.b64encode(self.registers.tobytes()).decode()
+
+    @classmethod
+    def from_base64(cls, registers: str, precision: int = 12) -> HyperLogLog:
+        sketch = cls(precision)
+        sketch.registers = np.frombuffer(base64.b64decode(registers), dtype = np.uint8).copy()
+
+        return sketch
+
+class SegmentProfile:
+    def __init__(self, 
+                 segment_name: str, 
+                 segment_col_specs: dict, 
+                 columns: list = None, 
+                 max_histogram_width: int = 3, 
+                 precision: int = 12):
+        '''
+        segment_name: Name of the segment being profiled (e.g., victim_segment).
+        segment_col_specs: col_specs[segment_name], i.e., column name -> [start, end]. It must list every column, since
+        the expected record length is where the last one ends.
+        columns: Columns that are decoded and profiled, defaulting to all (see NIBRSDecoder.get_selected_col_specs).
+        max_histogram_width: Columns at most this many characters wide are treated as coded fields (e.g.,
+        ucr_offense_code or sex_of_victim) and get a full value histogram.
+        precision: Precision of each column's HyperLogLog sketch.
+
+        Accumulates data-quality metrics while a segment is decoded: record lengths, per-column null counts,
+        approximate distinct counts, and value histograms of coded fields. Every metric is mergeable, so
+        update() can be called once per decoded table or once per batch.
+        '''
+        self.segment_name = segment_name
+        self.expected_record_length = max(end for _, end in segment_col_specs.values())
+        
+        columns = list(columns) if columns else list(segment_col_specs)
+        self.coded_columns = [
+            name for name, (start, end) in segment_col_specs.items() if name in columns and end - start <= max_histogram_width
+            ]
+
+        self.n_rows = 0
+        self.record_lengths = Counter()
+        self.null_counts = Counter()
+        self.sketches = {name: HyperLogLog(precision) for name in columns}
+        self.histograms = {name: Counter() for name in self.coded_columns}
+
+    def add_record_length(self, length: int) -> None:
+        self.record_lengths[length] += 1
+
+    def update(self, table: pd.DataFrame) -> None:
+        '''
+        table: Decoded rows of the segment (in full or one batch of it).
+        '''
+        import pandas as pd
+
+        self.n_rows += len(table)
+
+        for name, sketch in self.sketches.items():
+            column = table[name]
+            not_null = column.dropna()
+
+            self.null_counts[name] += len(column) - len(not_null)
+            sketch.add_hashes(pd.util.hash_pandas_object(not_null.astype(str), index = False).to_numpy())
+
+            if name in self.histograms:
+                self.histograms[name].update(
+                    {("null" if pd.isna(value) else str(value)): int(count) 
+                     for value, count in column.value_counts(dropna = False).items()}
+                    )
+
+    def to_dict(self) -> dict:
+        short_records = sum(count for length, count in self.record_lengths.items() if length < self.expected_record_length)
+
+        return {
+            "segment_name": self.segment_name,
+            "n_rows": self.n_rows,
+            "expected_record_length": self.expected_record_length,
+            "short_records": short_records,
+            "record_lengths": {str(length): count for length, count in sorted(self.record_lengths.items())},
+            "columns": {
+                name: {
+                    "null_count": self.null_counts[name],
+                    "pct_missing": round(self.null_counts[name] / self.n_rows, 4) if self.n_rows else None,
+                    "approx_distinct": sketch.estimate(),
+                    "hyperloglog": sketch.to_base64(),
+                    **({"histogram": dict(self.histograms[name].most_common())} if name in self.histograms else {})
+                }
+                for name, sketch in self.sketches.items()
+            }
+        }
@@ -1 +1,15 @@
-from .postgres import Postgres
\ No newline at end of file
+import importlib
+
+# sqlalchemy, psycopg2, and polars are only imported once Postgres is accessed: https://peps.python.org/pep-0562/
+_lazy_imports = {
+    "Postgres": "postgres",
+}
+
+def __getattr__(name: str):
+    if name in _lazy_imports:
+        return getattr(importlib.import_module(f".{_lazy_imports[name]}", __name__), name)
+    
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+
+def __dir__() -> list:
+    return sorted(set(globals()) | set(_lazy_imports))
@@ -0,0 +1,57 @@
+from sqlalchemy import MetaData, String, SmallInteger, Integer, Boolean, Date
+from sqlalchemy.orm import DeclarativeBase, mapped_column
+
+cleaned_metadata = MetaData(schema = "cleaned")
+
+class Base(DeclarativeBase):
+    metadata = cleaned_metadata
+
+# Star schema built from the raw tables by Postgres.update_star_schema. incident_fact is partitioned by data_year:
+# each year is built in the staging schema, then swapped in as the partition incident_fact_${year}.
+
+class AgencyDim(Base):
+    __tablename__ = "agency_dim"
+
+    ori = mapped_column(String, primary_key = True)
+    state_code = mapped_column(String)
+    first_year = mapped_column(SmallInteger)
+    last_year = mapped_column(SmallInteger)
+
+class OffenseCodeDim(Base):
+    __tablename__ = "offense_code_dim"
+
+    ucr_offense_code = mapped_column(String, primary_key = True)
+    offense_name = mapped_column(String)
+    offense_group = mapped_column(String) # A or B, as in archive/nibrs_codes.yml
+
+class DateDim(Base):
+    __tablename__ = "date_dim"
+
+    date_key = mapped_column(Date, primary_key = True)
+    year = mapped_column(SmallInteger, nullable = False)
+    quarter = mapped_column(SmallInteger, nullable = False)
+    month = mapped_column(SmallInteger, nullable = False)
+    day = mapped_column(SmallInteger, nullable = False)
+    weekday = mapped_column(SmallInteger, nullable = False) # ISO: Monday = 1, Sunday = 7
+
+class IncidentFact(Base):
+    '''
+    One row per administrative segment record. ucr_offense_code is the incident's first offense in the master file,
+    and is_cleared is True if the incident has an arrestee or was cleared exceptionally.
+    '''
+    __tablename__ = "incident_fact"
+    __table_args__ = {"postgresql_partition_by": "LIST (data_year)"}
+
+    data_year = mapped_column(SmallInteger, primary_key = True)
+    db_id = mapped_column(String, primary_key = True)
+    ori = mapped_column(String)
+    incident_number = mapped_column(String)
+    incident_date = mapped_column(Date)
+    incident_hour = mapped_column(SmallInteger)
+    ucr_offense_code = mapped_column(String)
+    n_offenses = mapped_column(Integer, nullable = False)
+    n_victims = mapped_column(Integer, nullable = False)
+    n_arrestees = mapped_column(Integer, nullable = False)
+    cleared_exceptionally = mapped_column(String)
+    exceptional_clearance_date = mapped_column(Date)
+    is_cleared = mapped_column(Boolean, nullable = False)
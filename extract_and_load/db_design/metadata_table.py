@@ -11,3 +11,14 @@ class IngestedFiles(Base):
     
     table = mapped_column(String, primary_key = True)
     ingestion_date = mapped_column(Date)
+
+class ProcessedFiles(Base):
+    '''
+    Tracks which ingested files each downstream stage (e.g., summarized) has already consumed, 
+    so that stages only process files that are new in ingested_files.
+    '''
+    __tablename__ = "processed_files"
+    
+    stage = mapped_column(String, primary_key = True)
+    table = mapped_column(String, primary_key = True)
+    processed_date = mapped_column(Date)
@@ -1,12 +1,23 @@
+from __future__ import annotations
+
 import sqlalchemy
 import psycopg2
-import polars as pl
 
 from datetime import date
 from io import StringIO
+from itertools import chain
+from typing import TYPE_CHECKING, Iterable, Iterator
+
+if TYPE_CHECKING:
+    import pandas as pd
+    import polars as pl
+
+from core import general
 
 from . import raw_tables
 from . import metadata_table
+from . import summarized_tables
+from . import cleaned_tables
 
 # https://www.psycopg.org/docs/cursor.html
 # https://www.psycopg.org/docs/connection.html
@@ -14,9 +25,50 @@ from . import metadata_table
 # https://docs.sqlalchemy.org/en/20/tutorial/data_insert.html
 # https://stackoverflow.com/questions/77160257/postgresql-create-database-cannot-run-inside-a-transaction-block
 
+class _CSVBatchStream:
+    '''
+    Read-only file-like object that serializes pandas dataframes to CSV lazily, one batch at a time, 
+    so that COPY ... FROM STDIN can consume a stream of batches without materializing all of them.
+    '''
+    def __init__(self, batches: Iterator[pd.DataFrame], db_id_prefix: str = None):
+        self.batches = batches
+        self.db_id_prefix = db_id_prefix
+        self.buffer = StringIO()
+        self.header = True
+        self.n_rows = 0
+    
+    def _load_next_batch(self) -> bool:
+        batch = next(self.batches, None)
+        if batch is None:
+            return False
+        
+        if self.db_id_prefix is not None:
+            batch["db_id"] = self.db_id_prefix + (batch.index + 1).astype(str)
+        
+        self.buffer = StringIO(batch.to_csv(index = False, header = self.header))
+        self.header = False
+        self.n_rows += len(batch)
+        
+        return True
+    
+    def read(self, size: int = -1) -> str:
+        chunks = []
+        while True:
+            chunk = self.buffer.read(size - sum(map(len, chunks)) if size >= 0 else -1)
+            chunks.append(chunk)
+            
+            if size >= 0 and sum(map(len, chunks)) == size:
+                break
+            if not self._load_next_batch():
+                break
+        
+        return "".join(chunks)
+
 class Postgres:
     raw_schema = raw_tables
     metadata_schema = metadata_table
+    summarized_schema = summarized_tables
+    cleaned_schema = cleaned_tables
     
     def __init__(self, credentials: dict, schemas: list):
         '''
@@ -100,6 +152,15 @@ class Postgres:
             connection.close()
             nibrs_db_connection.close()
     
+    @staticmethod
+    def get_decoded_columns(db_table: str) -> list:
+        '''
+        Returns the columns of db_table that come from decoding (i.e., all but row_hash), in table order.
+        '''
+        columns = Postgres.raw_schema.Base.metadata.tables[db_table].columns.keys()
+        
+        return [column for column in columns if column != "row_hash"]
+    
     @staticmethod
     def construct_copy_sql_code(table_name: str, columns: list) -> str:
         cols = "(" + ",".join(columns) + ")"
@@ -149,7 +210,7 @@ class Postgres:
             print(f"{source_file} was already ingested. Skipping...")
             return None
         
-        db_table_columns = Postgres.raw_schema.Base.metadata.tables[db_table].columns.keys()
+        db_table_columns = Postgres.get_decoded_columns(db_table)
         
         if list(table_to_ingest.columns) == list(db_table_columns):
             csv_buffer = StringIO()
@@ -174,3 +235,458 @@ class Postgres:
             
         else:
             raise Exception("Mismatched columns.")
+
+    def ingest_batches_into_db(self, 
+                               batches: Iterable[pd.DataFrame], 
+                               db_table: str, 
+                               source_file: str, 
+                               db_id_prefix: str = None) -> None:
+        '''
+        batches: pandas dataframes to ingest, e.g., NIBRSDecoder.iter_segment_batches().
+        db_table: Name of table in db, inclusive of schema (e.g., raw.arrests).
+        source_file: Name to record in metadata for idempotency (e.g., arrestee_segment_2022.parquet). Use the 
+        same name as the .parquet route so that a segment is never ingested twice, regardless of route.
+        db_id_prefix: If specified, a db_id column of db_id_prefix + (index + 1) is added to each batch, as decode.py does.
+        
+        Streams batches into db_table through a single COPY, serializing one batch at a time. The COPY and the 
+        ingested_files record are committed in the same transaction, so a failed run leaves no trace and can be retried.
+        '''
+        if self._is_file_ingested(source_file):
+            print(f"{source_file} was already ingested. Skipping...")
+            return None
+        
+        batches = iter(batches)
+        first_batch = next(batches, None)
+        if first_batch is None:
+            raise ValueError(f"No rows to ingest from {source_file}.")
+        
+        columns = list(first_batch.columns) + (["db_id"] if db_id_prefix is not None else [])
+        db_table_columns = Postgres.get_decoded_columns(db_table)
+        
+        if columns != list(db_table_columns):
+            raise Exception("Mismatched columns.")
+        
+        csv_stream = _CSVBatchStream(chain([first_batch], batches), db_id_prefix = db_id_prefix)
+        ingested_files = Postgres.metadata_schema.IngestedFiles.__table__
+        
+        connection = self._create_psycopg2_connection()
+        try:
+            with connection:
+                with connection.cursor() as cur:
+                    cur.copy_expert(
+                        sql = Postgres.construct_copy_sql_code(table_name = db_table, columns = columns), 
+                        file = csv_stream
+                    )
+                    cur.execute(
+                        f'insert into {ingested_files.fullname} ("table", ingestion_date) values (%s, %s)',
+                        (source_file, date.today())
+                    )
+        finally:
+            connection.close()
+        
+        print(f"Successfully streamed {csv_stream.n_rows} rows from '{source_file}' into '{db_table}.'")
+
+    @staticmethod
+    def _parse_source_file(source_file: str) -> tuple:
+        '''
+        source_file: File name of form ${segment_name}_${year}.parquet, as recorded in ingested_files.
+        
+        Returns the raw table and the year that source_file was ingested into, e.g., (raw.victim_segment, 2022).
+        '''
+        segment_name, data_year = source_file.replace(".parquet", "").rsplit("_", 1)
+        
+        return f"raw.{segment_name}", data_year
+    
+    def _find_unprocessed_files(self, connection: sqlalchemy.Connection, stage: str) -> list:
+        '''
+        Returns the files in ingested_files that stage has not yet recorded in processed_files.
+        '''
+        ingested = Postgres.metadata_schema.IngestedFiles
+        processed = Postgres.metadata_schema.ProcessedFiles
+        
+        stmt = (sqlalchemy.select(ingested.table)
+                .where(~sqlalchemy.exists().where(processed.stage == stage, processed.table == ingested.table))
+                .order_by(ingested.table))
+        
+        return list(connection.execute(stmt).scalars())
+    
+    @staticmethod
+    def _lock_stage(connection: sqlalchemy.Connection, stage: str) -> None:
+        '''
+        Serializes concurrent runs of the same stage (e.g., parallel ingestions) until the current transaction ends.
+        '''
+        connection.execute(sqlalchemy.text("select pg_advisory_xact_lock(hashtext(:stage))"), {"stage": stage})
+    
+    @staticmethod
+    def _record_processing(connection: sqlalchemy.Connection, stage: str, source_file: str) -> None:
+        processed = Postgres.metadata_schema.ProcessedFiles
+        
+        connection.execute(
+            sqlalchemy.insert(processed).values(stage = stage, table = source_file, processed_date = date.today())
+            )
+    
+    @staticmethod
+    def _is_file_processed(connection: sqlalchemy.Connection, stage: str, source_file: str) -> bool:
+        processed = Postgres.metadata_schema.ProcessedFiles
+        
+        stmt = sqlalchemy.select(processed).where(processed.stage == stage, processed.table == source_file)
+        
+        return bool(connection.execute(stmt).first())
+    
+    @staticmethod
+    def construct_summary_sql_code(summary_table: type) -> str:
+        '''
+        summary_table: Table from summarized_tables.
+        
+        Returns an upsert that adds the row counts of one year (:data_year) of summary_table.source_table 
+        onto the existing counts.
+        '''
+        table = summary_table.__table__
+        dimensions = [column for column in table.primary_key.columns.keys() if column != "data_year"]
+        
+        cols = ", ".join(dimensions)
+        values = ", ".join(f"coalesce({column}, '')" for column in dimensions)
+        
+        return (f"insert into {table.fullname} as target (data_year, {cols}, n_rows) "
+                f"select :data_year, {values}, count(*) from {summary_table.source_table} "
+                f"where split_part(db_id, '_', 1) = :data_year "
+                f"group by {values} "
+                f"on conflict (data_year, {cols}) do update set n_rows = target.n_rows + excluded.n_rows")
+    
+    def update_summaries(self) -> list:
+        '''
+        Adds the rows of every file in ingested_files that has not been summarized yet onto the tables in the 
+        summarized schema, instead of recomputing them from all of raw. Each file is summarized and recorded in 
+        processed_files in one transaction, so every file is counted exactly once. Returns the summarized files.
+        '''
+        stage = Postgres.summarized_schema.summarized_metadata.schema
+        summary_tables = [mapper.class_ for mapper in Postgres.summarized_schema.Base.registry.mappers]
+        engine = self.create_sqlalchemy_engine()
+        
+        with engine.begin() as conn:
+            new_files = self._find_unprocessed_files(conn, stage)
+        
+        summarized_files = []
+        for source_file in new_files:
+            db_table, data_year = Postgres._parse_source_file(source_file)
+            
+            with engine.begin() as conn:
+                Postgres._lock_stage(conn, stage)
+                
+                if Postgres._is_file_processed(conn, stage, source_file):
+                    continue
+                
+                for summary_table in summary_tables:
+                    if summary_table.source_table == db_table:
+                        conn.execute(sqlalchemy.text(Postgres.construct_summary_sql_code(summary_table)), 
+                                     {"data_year": data_year})
+                
+                Postgres._record_processing(conn, stage, source_file)
+            
+            summarized_files.append(source_file)
+            print(f"Summarized '{source_file}.'")
+        
+        return summarized_files
+    
+    @staticmethod
+    def _to_date_sql_code(column: str) -> str:
+        '''
+        Parses a yyyymmdd string (possibly with a trailing .0, since pandas infers column types), or returns null.
+        '''
+        pattern = "^\\s*(19|20)[0-9]{2}(0[1-9]|1[0-2])(0[1-9]|[12][0-9]|3[01])(\\.0+)?\\s*$"
+        
+        return f"case when {column} ~ '{pattern}' then to_date(left(trim({column}), 8), 'YYYYMMDD') end"
+    
+    @staticmethod
+    def _to_smallint_sql_code(column: str) -> str:
+        pattern = "^\\s*[0-9]{1,4}(\\.0+)?\\s*$"
+        
+        return f"case when {column} ~ '{pattern}' then trim({column})::numeric::smallint end"
+    
+    @staticmethod
+    def construct_incident_fact_sql_code(staging_table: str) -> str:
+        '''
+        staging_table: Table with the columns of cleaned.incident_fact.
+        
+        Returns an insert of one year (:data_year) of incidents into staging_table. The offense, victim, and arrestee 
+        segments are aggregated per incident first, so that each join onto the administrative segment is one-to-one.
+        '''
+        in_year = "split_part(db_id, '_', 1) = :data_year"
+        per_incident = "group by ori, incident_number"
+        
+        return (
+            f"with offenses as ("
+            f"    select ori, incident_number, count(*) as n_offenses, "
+            f"    (array_agg(trim(ucr_offense_code) order by split_part(db_id, '_', 2)::bigint))[1] as ucr_offense_code "
+            f"    from raw.offense_segment where {in_year} {per_incident}), "
+            f"victims as (select ori, incident_number, count(*) as n_victims from raw.victim_segment where {in_year} {per_incident}), "
+            f"arrestees as (select ori, incident_number, count(*) as n_arrestees from raw.arrestee_segment where {in_year} {per_incident}) "
+            f"insert into {staging_table} "
+            f"(data_year, db_id, ori, incident_number, incident_date, incident_hour, ucr_offense_code, n_offenses, n_victims, "
+            f"n_arrestees, cleared_exceptionally, exceptional_clearance_date, is_cleared) "
+            f"select cast(:data_year as smallint), a.db_id, a.ori, a.incident_number, "
+            f"{Postgres._to_date_sql_code('a.incident_date')}, {Postgres._to_smallint_sql_code('a.incident_date_hour')}, "
+            f"o.ucr_offense_code, coalesce(o.n_offenses, 0), coalesce(v.n_victims, 0), coalesce(r.n_arrestees, 0), "
+            f"trim(a.cleared_exceptionally), {Postgres._to_date_sql_code('a.exceptional_clearance_date')}, "
+            # Exceptional clearance codes A-E; N means not applicable.
+            f"coalesce(r.n_arrestees, 0) > 0 or coalesce(trim(a.cleared_exceptionally) in ('A', 'B', 'C', 'D', 'E'), false) "
+            f"from raw.administrative_segment a "
+            f"left join offenses o on o.ori = a.ori and o.incident_number = a.incident_number "
+            f"left join victims v on v.ori = a.ori and v.incident_number = a.incident_number "
+            f"left join arrestees r on r.ori = a.ori and r.incident_number = a.incident_number "
+            f"where split_part(a.db_id, '_', 1) = :data_year"
+        )
+    
+    @staticmethod
+    def construct_dimension_sql_code(staging_table: str) -> list:
+        '''
+        Returns the upserts that add the agencies, offense codes, and dates of staging_table to the dimension tables.
+        '''
+        agency_dim = Postgres.cleaned_schema.AgencyDim.__table__.fullname
+        offense_code_dim = Postgres.cleaned_schema.OffenseCodeDim.__table__.fullname
+        date_dim = Postgres.cleaned_schema.DateDim.__table__.fullname
+        
+        return [
+            f"insert into {agency_dim} as target (ori, state_code, first_year, last_year) "
+            f"select f.ori, max(a.state_code), f.data_year, f.data_year from {staging_table} f "
+            f"join raw.administrative_segment a on a.db_id = f.db_id "
+            f"where f.ori is not null group by f.ori, f.data_year "
+            f"on conflict (ori) do update set "
+            f"state_code = case when excluded.last_year >= target.last_year then excluded.state_code else target.state_code end, "
+            f"first_year = least(target.first_year, excluded.first_year), "
+            f"last_year = greatest(target.last_year, excluded.last_year)",
+            
+            f"insert into {offense_code_dim} (ucr_offense_code) "
+            f"select distinct ucr_offense_code from {staging_table} where ucr_offense_code is not null "
+            f"on conflict (ucr_offense_code) do nothing",
+            
+            f"insert into {date_dim} (date_key, year, quarter, month, day, weekday) "
+            f"select d, extract(year from d), extract(quarter from d), extract(month from d), extract(day from d), extract(isodow from d) "
+            f"from (select incident_date as d from {staging_table} union select exceptional_clearance_date from {staging_table}) dates "
+            f"where d is not null "
+            f"on conflict (date_key) do nothing"
+        ]
+    
+    def load_offense_codes(self, offense_codes: dict) -> None:
+        '''
+        offense_codes: {group_a_offenses: {code: name}, group_b_offenses: {code: name}}, as in archive/nibrs_codes.yml.
+        
+        Names the codes of offense_code_dim, adding those that were not observed yet.
+        '''
+        from sqlalchemy.dialects.postgresql import insert
+        
+        offense_code_dim = Postgres.cleaned_schema.OffenseCodeDim
+        rows = [
+            {"ucr_offense_code": str(code), "offense_name": name, "offense_group": group.split("_")[1].upper()}
+            for group, codes in offense_codes.items() for code, name in codes.items()
+        ]
+        
+        stmt = insert(offense_code_dim).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements = [offense_code_dim.ucr_offense_code],
+            set_ = {"offense_name": stmt.excluded.offense_name, "offense_group": stmt.excluded.offense_group}
+            )
+        
+        with self.create_sqlalchemy_engine().begin() as conn:
+            conn.execute(stmt)
+    
+    def update_star_schema(self) -> list:
+        '''
+        Rebuilds incident_fact in the cleaned schema for every year with files in ingested_files that the cleaned stage 
+        has not processed yet, and adds the agencies, offense codes, and dates of those years to the dimension tables. 
+        Each year is built with set-based SQL into staging.incident_fact_${year}, which then replaces the partition 
+        cleaned.incident_fact_${year} by detaching the old partition and attaching the new one. Readers keep using the 
+        old partition while the new one is built; the swap only changes the catalog, and it commits with the year's 
+        processed_files records in one transaction. Republished years (see upsert_table_into_db) are rebuilt the same 
+        way. Returns the rebuilt years.
+        '''
+        stage = Postgres.cleaned_schema.cleaned_metadata.schema
+        incident_fact = Postgres.cleaned_schema.IncidentFact.__table__.fullname
+        engine = self.create_sqlalchemy_engine()
+        
+        with engine.begin() as conn:
+            new_files = self._find_unprocessed_files(conn, stage)
+        
+        files_by_year = {}
+        for source_file in new_files:
+            _, data_year = Postgres._parse_source_file(source_file)
+            files_by_year.setdefault(data_year, []).append(source_file)
+        
+        rebuilt_years = []
+        for data_year, source_files in sorted(files_by_year.items()):
+            year = int(data_year)
+            staging_table = f"staging.incident_fact_{year}"
+            partition = f"{stage}.incident_fact_{year}"
+            
+            with engine.begin() as conn:
+                Postgres._lock_stage(conn, stage)
+                
+                source_files = [file for file in source_files if not Postgres._is_file_processed(conn, stage, file)]
+                if not source_files:
+                    continue
+                
+                statements = [
+                    f"drop table if exists {staging_table}",
+                    f"create table {staging_table} (like {incident_fact} including defaults)",
+                    Postgres.construct_incident_fact_sql_code(staging_table),
+                    f"alter table {staging_table} add primary key (data_year, db_id)",
+                    # Lets attach skip scanning the partition to validate its bound.
+                    f"alter table {staging_table} add constraint incident_fact_{year}_data_year check (data_year = {year})",
+                    f"analyze {staging_table}",
+                    *Postgres.construct_dimension_sql_code(staging_table)
+                ]
+                for statement in statements:
+                    conn.execute(sqlalchemy.text(statement), {"data_year": data_year} if ":data_year" in statement else {})
+                
+                if conn.execute(sqlalchemy.text("select to_regclass(:partition)"), {"partition": partition}).scalar():
+                    conn.execute(sqlalchemy.text(f"alter table {incident_fact} detach partition {partition}"))
+                    conn.execute(sqlalchemy.text(f"drop table {partition}"))
+                
+                conn.execute(sqlalchemy.text(f"alter table {staging_table} set schema {stage}"))
+                conn.execute(sqlalchemy.text(f"alter table {incident_fact} attach partition {partition} for values in ({year})"))
+                
+                for source_file in source_files:
+                    Postgres._record_processing(conn, stage, source_file)
+            
+            rebuilt_years.append(data_year)
+            print(f"Rebuilt {partition}.")
+        
+        return rebuilt_years
+
+    @staticmethod
+    def construct_row_hash_sql_code(columns: list, alias: str = None) -> str:
+        '''
+        Returns the md5 of a row's columns, canonicalized (see general.canonicalize_value), with nulls and blanks as \\N, 
+        joined by the unit separator, so that the hash does not depend on the route a table was decoded by.
+        '''
+        prefix = f"{alias}." if alias else ""
+        
+        def canonicalize(column: str) -> str:
+            value = general.canonicalize_value_sql(f"{prefix}{column}")
+            
+            return f"coalesce(nullif({value}, ''), '\\N')"
+        
+        values = ", ".join(canonicalize(column) for column in columns)
+        
+        return f"md5(concat_ws(E'\\x1f', {values}))"
+    
+    def _invalidate_downstream(self, cur: psycopg2.extensions.cursor, db_table: str, source_file: str, data_year: str) -> None:
+        '''
+        Clears what downstream stages derived from source_file, so that they process it again: the summarized counts 
+        of data_year and every processed_files record of source_file.
+        '''
+        for mapper in Postgres.summarized_schema.Base.registry.mappers:
+            summary_table = mapper.class_
+            if summary_table.source_table == db_table:
+                cur.execute(f"delete from {summary_table.__table__.fullname} where data_year = %s", (data_year,))
+        
+        processed_files = Postgres.metadata_schema.ProcessedFiles.__table__.fullname
+        cur.execute(f'delete from {processed_files} where "table" = %s', (source_file,))
+    
+    def upsert_table_into_db(self, table_to_ingest: pl.DataFrame, db_table: str, source_file: str, natural_key: list) -> dict:
+        '''
+        table_to_ingest: Polars dataframe of a whole (republished) master file's segment.
+        db_table: Name of table in db, inclusive of schema (e.g., raw.arrests).
+        source_file: Name of file from which table_to_ingest originates (e.g., arrestee_segment_2022.parquet).
+        natural_key: Columns that identify a row within a year (see natural_keys in col_specs.yml).
+        
+        Applies only the differences between table_to_ingest and the rows of the same year in db_table. The rows are 
+        copied into a temporary staging table, where each gets a content hash (row_hash), then one set-based 
+        DELETE removes rows that are no longer published and one MERGE updates rows whose hash changed and inserts 
+        new rows. Unchanged rows are never rewritten, and existing rows keep their db_id. Everything, including the 
+        ingested_files record and the invalidation of downstream stages, commits in one transaction. Returns the 
+        number of deleted and merged (inserted or updated) rows. Requires PostgreSQL 15 or later. Rows are matched 
+        on natural_key in canonical form (see general.canonicalize_value), so the first upsert of a year ingested 
+        with inferred types (e.g., victim_sequence_number = 1 rather than 001) does not replace the whole year.
+        '''
+        import polars as pl
+        
+        _, data_year = Postgres._parse_source_file(source_file)
+        columns = Postgres.get_decoded_columns(db_table)
+        
+        if list(table_to_ingest.columns) != columns:
+            raise Exception("Mismatched columns.")
+        
+        if table_to_ingest.select(natural_key).null_count().sum_horizontal().item():
+            raise ValueError(f"natural_key {natural_key} has nulls in {source_file}; rows are matched on it by equality.")
+        
+        if table_to_ingest.select(general.canonicalize_value(pl.col(column)) for column in natural_key).is_duplicated().any():
+            raise ValueError(f"natural_key {natural_key} is not unique in {source_file}; see find_duplicates.py.")
+        
+        hashed_columns = [column for column in columns if column != "db_id"]
+        
+        csv_buffer = StringIO()
+        table_to_ingest.write_csv(csv_buffer)
+        csv_buffer.seek(0)
+        
+        staging_table = f"staging_{db_table.split('.')[-1]}"
+        in_year = "split_part({alias}.db_id, '_', 1) = %(data_year)s"
+        # Years ingested before the string routes store inferred keys (e.g., 1 rather than 001), so keys are matched in
+        # their canonical form. Both sides are plain equalities, which still allow hash joins.
+        key_matches = " and ".join(
+            f"{general.canonicalize_value_sql(f't.{column}')} = {general.canonicalize_value_sql(f's.{column}')}" 
+            for column in natural_key
+            )
+        updated_columns = ", ".join(f"{column} = s.{column}" for column in hashed_columns + ["row_hash"])
+        inserted_columns = ", ".join(hashed_columns + ["db_id", "row_hash"])
+        inserted_values = ", ".join([f"s.{column}" for column in hashed_columns] + ["s.new_db_id", "s.row_hash"])
+        ingested_files = Postgres.metadata_schema.IngestedFiles.__table__.fullname
+        parameters = {"data_year": data_year}
+        
+        connection = self._create_psycopg2_connection()
+        try:
+            with connection:
+                with connection.cursor() as cur:
+                    cur.execute(f"alter table {db_table} add column if not exists row_hash varchar")
+                    
+                    # Rows ingested without upsert have no hash yet.
+                    cur.execute(
+                        f"update {db_table} t set row_hash = {Postgres.construct_row_hash_sql_code(hashed_columns, 't')} "
+                        f"where t.row_hash is null and {in_year.format(alias = 't')}", parameters
+                    )
+                    
+                    cur.execute(f"create temp table {staging_table} (like {db_table}) on commit drop")
+                    cur.copy_expert(
+                        sql = Postgres.construct_copy_sql_code(table_name = staging_table, columns = table_to_ingest.columns),
+                        file = csv_buffer
+                    )
+                    cur.execute(f"update {staging_table} s set row_hash = {Postgres.construct_row_hash_sql_code(hashed_columns, 's')}")
+                    cur.execute(f"analyze {staging_table}")
+                    
+                    cur.execute(
+                        f"delete from {db_table} t where {in_year.format(alias = 't')} "
+                        f"and not exists (select 1 from {staging_table} s where {key_matches})", parameters
+                    )
+                    n_deleted = cur.rowcount
+                    
+                    cur.execute(
+                        f"select coalesce(max(split_part(db_id, '_', 2)::bigint), 0) from {db_table} t "
+                        f"where {in_year.format(alias = 't')}", parameters
+                    )
+                    max_row_number = cur.fetchone()[0]
+                    
+                    cur.execute(
+                        f"merge into {db_table} t "
+                        f"using (select *, %(data_year)s || '_' || (%(max_row_number)s + row_number() over ()) as new_db_id "
+                        f"       from {staging_table}) s "
+                        f"on {in_year.format(alias = 't')} and {key_matches} "
+                        f"when matched and t.row_hash is distinct from s.row_hash then update set {updated_columns} "
+                        f"when not matched then insert ({inserted_columns}) values ({inserted_values})",
+                        {**parameters, "max_row_number": max_row_number}
+                    )
+                    n_merged = cur.rowcount
+                    
+                    if n_deleted or n_merged:
+                        self._invalidate_downstream(cur, db_table, source_file, data_year)
+                    
+                    cur.execute(
+                        f'insert into {ingested_files} ("table", ingestion_date) values (%s, %s) '
+                        f'on conflict ("table") do update set ingestion_date = excluded.ingestion_date',
+                        (source_file, date.today())
+                    )
+        finally:
+            connection.close()
+        
+        print(f"Upserted '{source_file}' into '{db_table}': {n_deleted} rows deleted, {n_merged} rows inserted or updated.")
+        
+        return {"deleted": n_deleted, "merged": n_merged}
@@ -1,4 +1,4 @@
-from sqlalchemy import MetaData, String
+from sqlalchemy import MetaData, String, Index, func
 from sqlalchemy.orm import DeclarativeBase, mapped_column
 
 raw_metadata = MetaData(schema = "raw")
@@ -6,6 +6,9 @@ raw_metadata = MetaData(schema = "raw")
 class Base(DeclarativeBase):
     metadata = raw_metadata
 
+# row_hash is not decoded: it is an md5 of a row's other columns, filled in by Postgres.upsert_table_into_db 
+# to detect changed rows when a master file is republished.
+
 class Administrative(Base):
     __tablename__ = "administrative_segment"
     
@@ -24,6 +27,7 @@ class Administrative(Base):
     cleared_exceptionally = mapped_column(String)
     exceptional_clearance_date = mapped_column(String)
     db_id = mapped_column(String, primary_key=True)
+    row_hash = mapped_column(String)
 
 class Offense(Base):
     __tablename__ = "offense_segment"
@@ -52,6 +56,7 @@ class Offense(Base):
     automatic_weapon_indicator3 = mapped_column(String)
     bias_motivation = mapped_column(String)
     db_id = mapped_column(String, primary_key=True)
+    row_hash = mapped_column(String)
 
 class Victim(Base):
     __tablename__ = "victim_segment"
@@ -98,6 +103,7 @@ class Victim(Base):
     victim_relationship_to_offender9 = mapped_column(String)
     victim_relationship_to_offender10 = mapped_column(String)
     db_id = mapped_column(String, primary_key=True)
+    row_hash = mapped_column(String)
 
 class Arrestee(Base):
     __tablename__ = "arrestee_segment"
@@ -124,3 +130,9 @@ class Arrestee(Base):
     residence_status_of_arrestee = mapped_column(String)
     disposition_arrestee_under_18 = mapped_column(String)
     db_id = mapped_column(String, primary_key=True)
+    row_hash = mapped_column(String)
+
+# db_id is of form ${year}_${row_number}. Downstream stages select the rows of one master file (year) through
+# this index instead of scanning every year.
+for table in raw_metadata.tables.values():
+    Index(f"ix_{table.name}_data_year", func.split_part(table.c.db_id, "_", 1))
@@ -0,0 +1,52 @@
+from sqlalchemy import MetaData, String, BigInteger
+from sqlalchemy.orm import DeclarativeBase, mapped_column
+
+summarized_metadata = MetaData(schema = "summarized")
+
+class Base(DeclarativeBase):
+    metadata = summarized_metadata
+
+# Each table counts the rows of source_table by its primary key columns other than data_year, which is
+# derived from db_id. Missing values are stored as '' since primary key columns cannot be null.
+
+class IncidentCounts(Base):
+    __tablename__ = "incident_counts"
+    source_table = "raw.administrative_segment"
+    
+    data_year = mapped_column(String, primary_key = True)
+    state_code = mapped_column(String, primary_key = True)
+    ori = mapped_column(String, primary_key = True)
+    cleared_exceptionally = mapped_column(String, primary_key = True)
+    n_rows = mapped_column(BigInteger, nullable = False)
+
+class OffenseCounts(Base):
+    __tablename__ = "offense_counts"
+    source_table = "raw.offense_segment"
+    
+    data_year = mapped_column(String, primary_key = True)
+    state_code = mapped_column(String, primary_key = True)
+    ori = mapped_column(String, primary_key = True)
+    ucr_offense_code = mapped_column(String, primary_key = True)
+    n_rows = mapped_column(BigInteger, nullable = False)
+
+class VictimCounts(Base):
+    __tablename__ = "victim_counts"
+    source_table = "raw.victim_segment"
+    
+    data_year = mapped_column(String, primary_key = True)
+    state_code = mapped_column(String, primary_key = True)
+    ori = mapped_column(String, primary_key = True)
+    ucr_offense_code1 = mapped_column(String, primary_key = True)
+    type_of_victim = mapped_column(String, primary_key = True)
+    n_rows = mapped_column(BigInteger, nullable = False)
+
+class ArresteeCounts(Base):
+    __tablename__ = "arrestee_counts"
+    source_table = "raw.arrestee_segment"
+    
+    data_year = mapped_column(String, primary_key = True)
+    state_code = mapped_column(String, primary_key = True)
+    ori = mapped_column(String, primary_key = True)
+    ucr_arrest_offense_code = mapped_column(String, primary_key = True)
+    type_of_arrest = mapped_column(String, primary_key = True)
+    n_rows = mapped_column(BigInteger, nullable = False)
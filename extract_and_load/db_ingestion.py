@@ -1,47 +1,79 @@
 import argparse
 
-from core import general, AmazonS3
+import polars as pl
+
+from core import general, AmazonS3, NIBRSDataset, S3Compactor
 from db_design import Postgres
 
 def main(args: argparse.Namespace):
     '''
     Ingests raw tables from Amazon S3 into database. Idempotent controls are already in place to
     prevent duplicate ingestion, so new files can be added onto the same S3 bucket for data refreshes.
+    With --upsert, files are diffed against the rows already ingested for their year instead, so that 
+    master files the FBI republished only apply the rows that were inserted, changed, or deleted.
+    Compacted segments are read from the objects in their manifest (see compact.py), but are still tracked 
+    under the name of their source file. With --input_dir, files are ingested from a local directory instead, 
+    where .arrow caches (see decode.py --arrow_cache) are memory-mapped rather than decoded from .parquet.
     '''
     config = general.load_yaml(args.config_file)
     postgres_config = general.load_yaml(args.postgres_config)
     
-    S3 = AmazonS3()
     postgres = Postgres(credentials = postgres_config.get("postgresql")["credentials"],
                         schemas = postgres_config.get("postgresql")["schemas"])
     
-    bucket_name = config["s3_bucket"]
-    parquet_files = S3.view_objects_in_s3_bucket(bucket_name = bucket_name, view_only = False)
-    
-    print(f"Found {len(parquet_files)} parquet files in {bucket_name} bucket...")
+    if args.input_dir:
+        segment_files = NIBRSDataset(args.input_dir).files
+        read_file = NIBRSDataset.read_file
+        
+        print(f"Found {len(segment_files)} segment files in {args.input_dir}...")
+    else:
+        S3 = AmazonS3()
+        bucket_name = config["s3_bucket"]
+        segment_files = S3Compactor(bucket_name, S3).list_segment_files() # skips sidecar files, e.g., .profile.json
+        read_file = lambda object_name: S3.read_parquet_file_from_s3_bucket(bucket_name = bucket_name, object_name = object_name)
+        
+        print(f"Found {len(segment_files)} segment files in {bucket_name} bucket...")
     
-    for file_name in parquet_files:
-        table_name = file_name.replace(".parquet", "").rsplit("_", 1)[0]
+    for (table_name, data_year), object_names in segment_files.items():
+        file_name = f"{table_name}_{data_year}.parquet"
+        
+        if args.upsert and args.years and data_year not in args.years:
+            continue
         
-        print(f"Processing {file_name}...")
+        print(f"Processing {file_name} ({len(object_names)} object(s))...")
         
-        table = S3.read_parquet_file_from_s3_bucket(
-            bucket_name = bucket_name,
-            object_name = file_name
-        )
+        table = pl.concat([read_file(object_name) for object_name in object_names])
         
-        postgres.ingest_table_into_db(
-            table_to_ingest = table,
-            db_table = f"raw.{table_name}",
-            source_file = file_name
-        )
+        if args.upsert:
+            postgres.upsert_table_into_db(
+                table_to_ingest = table,
+                db_table = f"raw.{table_name}",
+                source_file = file_name,
+                natural_key = config["natural_keys"][table_name]
+            )
+        else:
+            postgres.ingest_table_into_db(
+                table_to_ingest = table,
+                db_table = f"raw.{table_name}",
+                source_file = file_name
+            )
+    
+    print("Updating summaries...")
+    postgres.update_summaries()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--config_file", "-a", 
-                        help = ".yml file with s3_bucket key")
+                        help = ".yml file with s3_bucket and natural_keys keys")
     parser.add_argument("--postgres_config", "-b", 
                         help = ".yml file with postgresql key, under which exists credentials and schemas keys")
+    parser.add_argument("--input_dir", "-i",
+                        help = "if specified, files are ingested from this local directory instead of the S3 bucket")
+    parser.add_argument("--upsert",
+                        help = "if toggled, files are applied as row-level diffs, even if they were already ingested",
+                        action = "store_true")
+    parser.add_argument("--years", "-y", nargs = "+",
+                        help = "with --upsert, only files of these (republished) years are processed")
     
     args = parser.parse_args()
     
@@ -23,9 +23,22 @@ def create_tables(table_base: ModuleType,
     else:
         raise Exception(f"'{schema}' schema not found in postgres_config['schemas'].")
 
+def create_indexes(table_base: ModuleType, sqlalchemy_engine: Engine) -> None:
+    """
+    table_base: SQLAlchemy module that defines tables and corresponding metadata.
+    sqlalchemy_engine: A SQLAlchemy engine with proper credentials.
+    
+    Creates the indexes of table_base's tables that do not exist yet. create_all skips tables that already exist,
+    so indexes added to an existing table are only created here, once, rather than by the ingestion jobs.
+    """
+    with sqlalchemy_engine.begin() as conn:
+        for table in table_base.Base.metadata.tables.values():
+            for index in table.indexes:
+                index.create(conn, checkfirst = True)
+
 def main(config_file: dict):
     '''
-    Creates database and schemas based on config_file["postgresql"]. Finally, creates tables in raw and metadata schemas.
+    Creates database and schemas based on config_file["postgresql"]. Finally, creates tables in raw, metadata, summarized, and cleaned schemas.
     '''
     postgres_config = config_file["postgresql"]
     
@@ -35,7 +48,10 @@ def main(config_file: dict):
 
     sqlalchemy_engine = db_config.create_sqlalchemy_engine()
     create_tables(Postgres.raw_schema, sqlalchemy_engine, postgres_config)
+    create_indexes(Postgres.raw_schema, sqlalchemy_engine)
     create_tables(Postgres.metadata_schema, sqlalchemy_engine, postgres_config)
+    create_tables(Postgres.summarized_schema, sqlalchemy_engine, postgres_config)
+    create_tables(Postgres.cleaned_schema, sqlalchemy_engine, postgres_config)
     
     print("Done.")
 
@@ -1,10 +1,12 @@
 import argparse
+import hashlib
+import json
 import re
 
 from pathlib import Path
 from time import perf_counter
 
-from core import NIBRSDecoder, AmazonS3, general
+from core import NIBRSDecoder, AmazonS3, SegmentProfile, general
 
 def get_year(file_name: str) -> int:
     '''
@@ -17,37 +19,109 @@ def get_year(file_name: str) -> int:
     else:
         raise ValueError(f"Expected file name as nibrs-${{year}}.txt, not {file_name}.")
 
+def get_extract_suffix(states: list = None, oris: list = None, columns: list = None) -> str:
+    '''
+    Returns the suffix of a filtered extract or column projection (e.g., .states-IL-WI), or an empty string if nothing 
+    is filtered. Readers of ${segment_name}_${year}.parquet (db_ingestion.py, NIBRSDataset, compact.py, etc.) treat it 
+    as the whole year with every column, so an extract must never be written under that name. Long lists are replaced 
+    by a short hash of their values. Pass the values as normalized by NIBRSDecoder (e.g., upper-case states), so that 
+    the same extract always gets the same name.
+    '''
+    suffix = ""
+    for name, values in (("states", states), ("oris", oris), ("columns", columns)):
+        if values:
+            label = "-".join(sorted(set(values)))
+            if len(label) > 40:
+                label = hashlib.md5(label.encode()).hexdigest()[:10]
+            suffix += f".{name}-{label}"
+    
+    return suffix
+
 def main(args: argparse.Namespace):
     config = general.load_yaml(args.config_file)
     s3_bucket = config["s3_bucket"]
     
     start = perf_counter()
-    output_dir, logger = general.create_output_dir(args.output_dir, f"{Path(__file__).stem}.log")
+    reporting_year = get_year(args.nibrs_master_file)
+    
+    # One log per segment and year, since make -j and the orchestrator run several decodes at once.
+    output_dir, logger = general.create_output_dir(args.output_dir, f"{Path(__file__).stem}_{args.segment_name}_{reporting_year}.log")
     
     # Step 1: Extract segment.
-    reporting_year = get_year(args.nibrs_master_file)
-        
     logger.info(f"Decoding {args.segment_name}...")
     
-    decoder = NIBRSDecoder(args.nibrs_master_file, config)
+    decoder = NIBRSDecoder(args.nibrs_master_file, config, states = args.states, oris = args.oris, columns = args.columns)
+    profile = SegmentProfile(
+        args.segment_name, config[args.segment_name], columns = decoder.get_col_names_for_segment(args.segment_name)
+        ) if args.profile else None
+    
+    out_stem = f"{args.segment_name}_{reporting_year}{get_extract_suffix(decoder.states, decoder.oris, decoder.columns)}"
+    out_name = f"{out_stem}.parquet"
+    profile_name = f"{out_stem}.profile.json"
+    
+    if args.to_postgres:
+        # Decode and COPY batch by batch, skipping the .parquet round trip entirely.
+        from db_design import Postgres # sqlalchemy and psycopg2 are only needed on this route
+        
+        postgres_config = general.load_yaml(args.postgres_config)["postgresql"]
+        postgres = Postgres(credentials = postgres_config["credentials"], schemas = postgres_config["schemas"])
+        
+        logger.info("Streaming segment into database...")
+        postgres.ingest_batches_into_db(
+            batches = decoder.iter_segment_batches(args.segment_name, batch_size = args.batch_size, profile = profile),
+            db_table = f"raw.{args.segment_name}",
+            source_file = out_name,
+            db_id_prefix = f"{reporting_year}_"
+        )
+        postgres.update_summaries()
+        
+        if profile:
+            output_dir.joinpath(profile_name).write_text(json.dumps(profile.to_dict(), indent = 2))
+        
+        logger.info(f"Done. Total run time: {round((perf_counter() - start) / 60, 2)} minutes.")
+        return None
     
-    out_table = decoder.decode_segment(args.segment_name)
-    out_table["db_id"] = f"{reporting_year}_" + (out_table.index + 1).astype(str)
+    if args.checkpoint:
+        # Decode chunk by chunk into part files so that a restarted run resumes after the last committed chunk.
+        out_file = decoder.decode_segment_checkpointed(
+            args.segment_name, output_dir.joinpath(out_name), 
+            db_id_prefix = f"{reporting_year}_", 
+            chunk_bytes = args.chunk_mb * 1024 ** 2, 
+            profile = profile
+        )
+    else:
+        out_table = decoder.decode_segment(args.segment_name, profile = profile)
+        out_table["db_id"] = f"{reporting_year}_" + (out_table.index + 1).astype(str)
     
     
     # Step 2: Export.
-    out_name = f"{args.segment_name}_{reporting_year}.parquet"
-    
     logger.info("Exporting...")
     if args.to_s3:
         logger.info("Sending segment to S3 bucket...")
         S3 = AmazonS3()
-        S3.upload_table_to_s3_bucket(
-            table = out_table, how = "parquet",
-            bucket_name = s3_bucket, object_name = out_name
-            )
+        if args.checkpoint:
+            S3.upload_file_to_s3_bucket(file = str(out_file), bucket_name = s3_bucket, object_name = out_name)
+        else:
+            S3.upload_table_to_s3_bucket(
+                table = out_table, how = "parquet",
+                bucket_name = s3_bucket, object_name = out_name
+                )
+        if profile:
+            S3.upload_dict_to_s3_bucket(profile.to_dict(), bucket_name = s3_bucket, object_name = profile_name)
     else:
-        out_table.to_parquet(output_dir.joinpath(out_name))
+        if not args.checkpoint:
+            out_table.to_parquet(output_dir.joinpath(out_name), index = False)
+        if profile:
+            output_dir.joinpath(profile_name).write_text(json.dumps(profile.to_dict(), indent = 2))
+    
+    if args.arrow_cache:
+        # A memory-mappable copy for local work, converted from the local .parquet file (written first if needed).
+        from core import NIBRSDataset # polars is only needed on this route
+        
+        logger.info("Writing Arrow IPC cache...")
+        if args.to_s3 and not args.checkpoint:
+            out_table.to_parquet(output_dir.joinpath(out_name), index = False)
+        NIBRSDataset.convert_to_arrow(output_dir.joinpath(out_name), compression = args.arrow_cache)
     
     end = perf_counter()
     
@@ -63,9 +137,42 @@ if __name__ == "__main__":
     parser.add_argument("--config_file", "-c", 
                         help = ".yml file with segment_level_codes and s3_bucket keys",
                         default = "configuration/col_specs.yml")
-    parser.add_argument("--to_s3",
-                        help = "if toggled, the segment will be uploaded to an S3 bucket",
+    destination = parser.add_mutually_exclusive_group()
+    destination.add_argument("--to_s3",
+                             help = "if toggled, the segment will be uploaded to an S3 bucket",
+                             action = "store_true")
+    destination.add_argument("--to_postgres",
+                             help = "if toggled, the segment is streamed straight into its raw table instead of a .parquet file",
+                             action = "store_true")
+    parser.add_argument("--postgres_config", "-p",
+                        help = ".yml file with postgresql key, under which exists credentials and schemas keys (required by --to_postgres)",
+                        default = "configuration/config.yml")
+    parser.add_argument("--checkpoint",
+                        help = ("if toggled, the segment is decoded in chunks that are committed to output_dir as they finish, "
+                                "so that a rerun after a crash resumes where the previous run stopped"),
                         action = "store_true")
+    parser.add_argument("--chunk_mb", type = int,
+                        help = "size of the master file chunks decoded at a time with --checkpoint",
+                        default = 256)
+    parser.add_argument("--batch_size", type = int,
+                        help = "number of records decoded at a time with --to_postgres",
+                        default = 500_000)
+    parser.add_argument("--profile",
+                        help = "if toggled, a data-quality profile (.profile.json) is written alongside the .parquet file",
+                        action = "store_true")
+    parser.add_argument("--arrow_cache", choices = ("uncompressed", "lz4"), # NIBRSDataset.arrow_compressions
+                        help = ("if specified, the segment is also written to output_dir as a memory-mappable Arrow IPC file "
+                                "(.arrow) with this compression, which NIBRSDataset and db_ingestion.py read instead of the .parquet file"))
+    parser.add_argument("--states", nargs = "+",
+                        help = ("if specified, only records with these state codes are decoded (e.g., --states IL WI), "
+                                "into ${segment_name}_${year}.states-IL-WI.parquet rather than the file of the whole year"))
+    parser.add_argument("--oris", nargs = "+",
+                        help = ("if specified, only records of these agencies are decoded, "
+                                "into ${segment_name}_${year}.oris-${oris}.parquet rather than the file of the whole year"))
+    parser.add_argument("--columns", nargs = "+",
+                        help = ("if specified, only these columns of the segment are decoded, along with segment_level "
+                                "and the key columns (ori, incident_number, and the segment's natural_keys), "
+                                "into ${segment_name}_${year}.columns-${columns}.parquet rather than the file of the whole year"))
     
     parser.add_argument("--nibrs_master_file", "-f", 
                         help = "path to NIBRS master file (.txt)")
@@ -74,4 +181,11 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
     
+    if args.checkpoint and args.to_postgres:
+        parser.error("--checkpoint is not supported with --to_postgres, which commits the segment in one transaction.")
+    if args.arrow_cache and args.to_postgres:
+        parser.error("--arrow_cache is not supported with --to_postgres, which writes no .parquet file.")
+    if (args.states or args.oris or args.columns) and args.to_postgres:
+        parser.error("--states, --oris, and --columns are not supported with --to_postgres, which records the segment as ingested in full.")
+    
     main(args)
@@ -0,0 +1,102 @@
+import argparse
+import re
+
+from pathlib import Path
+from time import perf_counter
+
+from core import AmazonS3, DuplicateFinder, S3Compactor, general
+
+def list_segment_files(args: argparse.Namespace, bucket_name: str) -> list:
+    '''
+    Returns the {segment_name}_{year}.parquet files to check, as local paths or bucket_name/object_name paths.
+    '''
+    pattern = re.compile(rf"{args.segment_name}_([0-9]{{4}})\.parquet")
+    
+    if args.from_s3:
+        segment_files = S3Compactor(bucket_name).list_segment_files()
+        candidates = {
+            f"{segment_name}_{year}.parquet": [f"{bucket_name}/{object_name}" for object_name in object_names]
+            for (segment_name, year), object_names in segment_files.items()
+        }
+    else:
+        candidates = {file.name: [str(file)] for file in Path(args.input_dir).glob("*.parquet")}
+    
+    files = []
+    for file_name, paths in sorted(candidates.items()):
+        match = pattern.fullmatch(file_name)
+        if match and (not args.years or match.group(1) in args.years):
+            files.extend(paths)
+    
+    return files
+
+def main(args: argparse.Namespace):
+    '''
+    Finds exact and conflicting duplicates of one segment across all years with bounded memory, so that records 
+    resubmitted across master files can be caught before they are ingested into raw tables.
+    '''
+    config = general.load_yaml(args.config_file)
+    
+    start = perf_counter()
+    output_dir, logger = general.create_output_dir(args.output_dir, f"{Path(__file__).stem}.log")
+    
+    files = list_segment_files(args, config["s3_bucket"])
+    logger.info(f"Checking {len(files)} {args.segment_name} files for duplicates...")
+    
+    finder = DuplicateFinder(
+        natural_key = config["natural_keys"][args.segment_name],
+        spill_dir = output_dir.joinpath(f"spill_{args.segment_name}"),
+        n_partitions = args.n_partitions,
+        batch_size = args.batch_size
+    )
+    filesystem = AmazonS3().create_pyarrow_filesystem() if args.from_s3 else None
+    
+    try:
+        for file in files:
+            n_rows = finder.add_parquet_file(file, filesystem = filesystem)
+            logger.info(f"Hashed {n_rows} rows from {file}.")
+        
+        duplicates = finder.find_duplicates()
+    finally:
+        finder.cleanup()
+    
+    out_file = output_dir.joinpath(f"duplicates_{args.segment_name}.parquet")
+    duplicates.write_parquet(out_file)
+    
+    for duplicate_type, n_rows in duplicates.group_by("duplicate_type").len().rows():
+        logger.info(f"Found {n_rows} rows in {duplicate_type} duplicate groups.")
+    
+    end = perf_counter()
+    
+    logger.info(f"Report written to {out_file}. Total run time: {round((end - start) / 60, 2)} minutes.")
+
+if __name__ == "__main__":
+    supported_segments = ("administrative", "offense", "arrestee", "victim")
+    
+    parser = argparse.ArgumentParser(description = "Finds duplicate records of a segment across years with bounded memory.")
+    
+    parser.add_argument("--input_dir", "-i", 
+                        help = "directory with {segment_name}_{year}.parquet files",
+                        default = "output")
+    parser.add_argument("--output_dir", "-o", 
+                        default = "output")
+    parser.add_argument("--config_file", "-c", 
+                        help = ".yml file with natural_keys and s3_bucket keys",
+                        default = "configuration/col_specs.yml")
+    parser.add_argument("--from_s3",
+                        help = "if toggled, the .parquet files are streamed from the S3 bucket instead of input_dir",
+                        action = "store_true")
+    
+    parser.add_argument("--segment_name", "-s", choices = [f"{name}_segment" for name in supported_segments],
+                        help = "segment of interest that is present as a distinct key in config_file")
+    parser.add_argument("--years", "-y", nargs = "+",
+                        help = "years to check, defaulting to all")
+    parser.add_argument("--n_partitions", type = int,
+                        help = "number of spill files; more partitions means less memory when comparing hashes",
+                        default = 64)
+    parser.add_argument("--batch_size", type = int,
+                        help = "number of rows read at a time",
+                        default = 250_000)
+    
+    args = parser.parse_args()
+    
+    main(args)
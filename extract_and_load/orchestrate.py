@@ -0,0 +1,371 @@
+import argparse
+import os
+
+from argparse import Namespace
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from pathlib import Path
+from time import perf_counter
+
+from core import general
+
+# https://docs.python.org/3/library/concurrent.futures.html#processpoolexecutor
+
+GB = 1024 ** 3
+
+# Prerequisites of the decoding rule in Makefile besides the master file.
+DECODE_SCRIPTS = [Path(__file__).parent.joinpath("decode.py"), Path(__file__).parent.joinpath("core", "nibrs.py")]
+
+@dataclass
+class Task:
+    '''
+    One node of the pipeline DAG. kind is one of unzip, decode, upload, or ingest; memory_gb is
+    the estimated peak memory of the task, filled in once its dependencies have finished.
+    '''
+    kind: str
+    year: str
+    segment: str = None
+    depends_on: list = field(default_factory = list)
+    memory_gb: float = 0.0
+
+    @property
+    def name(self) -> str:
+        return f"{self.kind}:{self.year}" + (f":{self.segment}" if self.segment else "")
+
+def run_task(kind: str, kwargs: dict) -> None:
+    '''
+    Entry point executed inside the worker processes. The pool reuses its processes across tasks,
+    so the heavy imports below are paid once per worker rather than once per task.
+    '''
+    if kind == "unzip":
+        import unzip
+        unzip.main(nibrs_master_file = kwargs["zip_file"])
+    elif kind == "decode":
+        import decode
+        decode.main(Namespace(**kwargs))
+    elif kind == "upload":
+        from core import AmazonS3
+        S3 = AmazonS3()
+        for file in kwargs["files"]:
+            S3.upload_file_to_s3_bucket(file = file, bucket_name = kwargs["bucket_name"], object_name = Path(file).name)
+    elif kind == "ingest":
+        import polars as pl
+        from db_design import Postgres
+
+        postgres_config = general.load_yaml(kwargs["postgres_config"])["postgresql"]
+        postgres = Postgres(credentials = postgres_config["credentials"], schemas = postgres_config["schemas"])
+        postgres.ingest_table_into_db(
+            table_to_ingest = pl.read_parquet(kwargs["parquet_file"]),
+            db_table = kwargs["db_table"],
+            source_file = Path(kwargs["parquet_file"]).name
+        )
+        postgres.update_summaries()
+    else:
+        raise ValueError(f"Invalid task kind '{kind}'.")
+
+class PipelineOrchestrator:
+    def __init__(self, args: argparse.Namespace, logger):
+        '''
+        args: Parsed command-line arguments (see the bottom of this file).
+        logger: Logger used for progress reports.
+
+        Builds the same years x segments DAG as Makefile (unzip -> decode -> upload -> ingest) and runs it
+        on a pool of warm worker processes. A task is only submitted if the sum of the estimated memory
+        of all running tasks stays within args.memory_gb; args.workers caps the number of CPUs in use.
+        '''
+        self.args = args
+        self.logger = logger
+        self.raw_data_dir = Path(args.raw_data_dir)
+        self.output_dir = Path(args.output_dir)
+        self.tasks = self._build_dag()
+
+    def _zip_file(self, year: str) -> Path:
+        return self.raw_data_dir.joinpath(f"nibrs-{year}.zip")
+
+    def _ascii_file(self, year: str) -> Path:
+        return self.raw_data_dir.joinpath(f"nibrs-{year}.txt")
+
+    def _parquet_file(self, task: Task) -> Path:
+        return self.output_dir.joinpath(f"{task.segment}_segment_{task.year}.parquet")
+
+    def _flag_file(self, year: str, segment: str) -> Path:
+        '''
+        With --to_s3, the same dummy flag as Makefile, which means that the segment on S3 is up-to-date, so both entry 
+        points agree on it. Without, a separate .local flag, so that local runs never make Makefile skip an upload.
+        '''
+        flag_name = f"{segment}_segment_from_{self._ascii_file(year).name}"
+        
+        return self.output_dir.joinpath(flag_name if self.args.to_s3 else f"{flag_name}.local")
+
+    def _is_up_to_date(self, year: str, segment: str) -> bool:
+        '''
+        Like the Makefile rule, a segment is stale if its flag is older than the zip file or the decoding code.
+        '''
+        flag = self._flag_file(year, segment)
+        dependencies = [self._zip_file(year), *DECODE_SCRIPTS]
+
+        return (not self.args.force
+                and flag.exists()
+                and all(flag.stat().st_mtime >= dependency.stat().st_mtime for dependency in dependencies))
+
+    def _build_dag(self) -> dict:
+        tasks = {}
+
+        for year in self.args.years or sorted(general.find_years(self.raw_data_dir)):
+            segments = [segment for segment in self.args.segments if not self._is_up_to_date(year, segment)]
+
+            if not segments:
+                continue
+
+            ascii_file = self._ascii_file(year)
+            unzip_task = None
+
+            if (self.args.force or not ascii_file.exists()
+                    or ascii_file.stat().st_mtime < self._zip_file(year).stat().st_mtime):
+                unzip_task = Task("unzip", year)
+                tasks[unzip_task.name] = unzip_task
+
+            for segment in segments:
+                chain = [Task("decode", year, segment, depends_on = [unzip_task.name] if unzip_task else [])]
+
+                if self.args.to_s3:
+                    chain.append(Task("upload", year, segment, depends_on = [chain[-1].name]))
+                if self.args.postgres_config:
+                    chain.append(Task("ingest", year, segment, depends_on = [chain[-1].name]))
+
+                for task in chain:
+                    tasks[task.name] = task
+
+        return tasks
+
+    def _estimate_memory(self, task: Task) -> float:
+        '''
+        Rough peak memory (GB) of a task, sized from its input file on disk. decode_segment holds the
+        segment's text plus a pandas frame of it, hence a multiple of the master file's size.
+        '''
+        if task.kind == "unzip":
+            return self.args.unzip_memory_gb
+        elif task.kind == "decode":
+            return self._ascii_file(task.year).stat().st_size * self.args.decode_memory_factor / GB
+        elif task.kind == "upload":
+            return self.args.unzip_memory_gb
+        else:
+            return self._parquet_file(task).stat().st_size * self.args.ingest_memory_factor / GB
+
+    def _task_arguments(self, task: Task) -> dict:
+        if task.kind == "unzip":
+            return {"zip_file": str(self._zip_file(task.year))}
+        elif task.kind == "decode":
+            return {
+                "output_dir": str(self.output_dir),
+                "config_file": self.args.config_file,
+                "to_s3": False,
+                "to_postgres": False,
+                "postgres_config": self.args.postgres_config,
+                "batch_size": None,
+                "checkpoint": self.args.checkpoint,
+                "chunk_mb": self.args.chunk_mb,
+                "profile": self.args.profile,
+                "states": None,
+                "oris": None,
+                "columns": None,
+                "arrow_cache": None,
+                "nibrs_master_file": str(self._ascii_file(task.year)),
+                "segment_name": f"{task.segment}_segment"
+            }
+        elif task.kind == "upload":
+            parquet_file = self._parquet_file(task)
+            sidecars = [parquet_file.with_suffix(".profile.json")] if self.args.profile else []
+            
+            return {
+                "files": [str(file) for file in [parquet_file, *sidecars]],
+                "bucket_name": general.load_yaml(self.args.config_file)["s3_bucket"]
+            }
+        else:
+            return {
+                "postgres_config": self.args.postgres_config,
+                "parquet_file": str(self._parquet_file(task)),
+                "db_table": f"raw.{task.segment}_segment"
+            }
+
+    def _is_last_in_chain(self, task: Task) -> bool:
+        return not any(task.name in other.depends_on for other in self.tasks.values())
+
+    def run(self) -> bool:
+        '''
+        Returns True if every task succeeded. Tasks downstream of a failure are skipped, but
+        independent branches of the DAG keep running.
+
+        If a worker is killed (e.g., by the OOM killer), the pool breaks and every task in flight fails with
+        BrokenProcessPool, although only one of them died. The pool is then rebuilt and those tasks are requeued
+        as suspects, which only run on an otherwise idle pool: a suspect that breaks the pool on its own is the
+        one that died and counts as failed, and the others finish as usual.
+        '''
+        pending = dict(self.tasks)
+        running = {}
+        done, failed, suspects = set(), set(), set()
+        total = len(pending)
+        memory_in_use = 0.0
+
+        self.logger.info(f"Scheduling {total} tasks on {self.args.workers} workers within {self.args.memory_gb} GB.")
+
+        pool = ProcessPoolExecutor(max_workers = self.args.workers)
+        try:
+            while pending or running:
+                for name, task in list(pending.items()):
+                    if any(dependency in failed for dependency in task.depends_on):
+                        self.logger.warning(f"Skipping {name}: an upstream task failed.")
+                        failed.add(name)
+                        del pending[name]
+
+                ready = [task for task in pending.values() if all(d in done for d in task.depends_on)]
+
+                for task in sorted(ready, key = lambda task: (task.name not in suspects, -self._estimate_memory(task))):
+                    if len(running) >= self.args.workers:
+                        break
+                    # A suspect runs alone, so that a second break of the pool can only be its own.
+                    if running and (task.name in suspects or any(other.name in suspects for other, _ in running.values())):
+                        break
+
+                    task.memory_gb = self._estimate_memory(task)
+
+                    # A task larger than the whole budget is still run, but only on an otherwise idle pool.
+                    if running and memory_in_use + task.memory_gb > self.args.memory_gb:
+                        continue
+
+                    try:
+                        future = pool.submit(run_task, task.kind, self._task_arguments(task))
+                    except BrokenProcessPool:
+                        break # the tasks in flight fail with BrokenProcessPool too, and are handled below
+
+                    running[future] = (task, perf_counter())
+                    memory_in_use += task.memory_gb
+                    del pending[task.name]
+
+                if not running:
+                    if not ready:
+                        break
+                    # submit found the pool broken with nothing in flight.
+                    pool.shutdown(wait = False, cancel_futures = True)
+                    pool = ProcessPoolExecutor(max_workers = self.args.workers)
+                    continue
+
+                finished, _ = wait(running, return_when = FIRST_COMPLETED)
+                if any(isinstance(future.exception(), BrokenProcessPool) for future in finished):
+                    # Every future in flight is failed by the pool once it breaks; collect all of them.
+                    finished, _ = wait(running)
+
+                broken = []
+                for future in finished:
+                    task, start = running.pop(future)
+                    memory_in_use -= task.memory_gb
+                    elapsed = round(perf_counter() - start, 1)
+
+                    try:
+                        future.result()
+                        done.add(task.name)
+                        suspects.discard(task.name)
+
+                        if self._is_last_in_chain(task) and task.segment:
+                            self._flag_file(task.year, task.segment).write_text("Done\n")
+
+                        self.logger.info(
+                            f"[{len(done) + len(failed)}/{total}] {task.name} finished in {elapsed}s "
+                            f"({len(running)} running, {round(memory_in_use, 1)} GB reserved)."
+                        )
+                    except BrokenProcessPool:
+                        broken.append(task)
+                    except Exception as e:
+                        failed.add(task.name)
+                        self.logger.error(f"[{len(done) + len(failed)}/{total}] {task.name} failed after {elapsed}s: {e!r}")
+
+                if not broken:
+                    continue
+
+                if len(broken) == 1:
+                    task = broken[0]
+                    failed.add(task.name)
+                    self.logger.error(f"[{len(done) + len(failed)}/{total}] {task.name} failed: its worker was killed (e.g., out of memory).")
+                else:
+                    self.logger.warning(
+                        f"A worker was killed with {len(broken)} tasks in flight; requeuing them to run one at a time: "
+                        f"{', '.join(task.name for task in broken)}."
+                    )
+                    for task in broken:
+                        pending[task.name] = task
+                        suspects.add(task.name)
+
+                pool.shutdown(wait = False, cancel_futures = True)
+                pool = ProcessPoolExecutor(max_workers = self.args.workers)
+        finally:
+            pool.shutdown()
+
+        return not failed
+
+def main(args: argparse.Namespace):
+    output_dir, logger = general.create_output_dir(args.output_dir, f"{Path(__file__).stem}.log")
+
+    start = perf_counter()
+    orchestrator = PipelineOrchestrator(args, logger)
+    success = orchestrator.run()
+    end = perf_counter()
+
+    logger.info(f"Done. Total run time: {round((end - start) / 60, 2)} minutes.")
+
+    if not success:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    supported_segments = ("administrative", "offense", "arrestee", "victim")
+
+    parser = argparse.ArgumentParser(description = "Runs unzip, decode, upload, and ingest for years x segments on a resource-aware worker pool.")
+
+    parser.add_argument("--raw_data_dir", "-r",
+                        default = "raw_data")
+    parser.add_argument("--output_dir", "-o",
+                        default = "output")
+    parser.add_argument("--config_file", "-c",
+                        help = ".yml file with segment_level_codes and s3_bucket keys",
+                        default = "configuration/col_specs.yml")
+    parser.add_argument("--postgres_config", "-p",
+                        help = "if specified, decoded segments are ingested into the database defined in this .yml file")
+    parser.add_argument("--to_s3",
+                        help = "if toggled, decoded segments are uploaded to the S3 bucket",
+                        action = "store_true")
+    parser.add_argument("--years", "-y", nargs = "+",
+                        help = "years to process, defaulting to every nibrs-${year}.zip in raw_data_dir")
+    parser.add_argument("--segments", "-s", nargs = "+", choices = supported_segments,
+                        default = list(supported_segments))
+    parser.add_argument("--profile",
+                        help = "if toggled, each decoded segment gets a data-quality profile (.profile.json)",
+                        action = "store_true")
+    parser.add_argument("--checkpoint",
+                        help = "if toggled, segments are decoded in committed chunks and resume after a crash (see decode.py)",
+                        action = "store_true")
+    parser.add_argument("--chunk_mb", type = int,
+                        help = "size of the master file chunks decoded at a time with --checkpoint",
+                        default = 256)
+    parser.add_argument("--force",
+                        help = "if toggled, up-to-date flags and unzipped files are ignored",
+                        action = "store_true")
+
+    parser.add_argument("--workers", "-j", type = int,
+                        help = "maximum number of concurrent tasks (CPU budget)",
+                        default = os.cpu_count())
+    parser.add_argument("--memory_gb", "-m", type = float,
+                        help = "memory budget shared by all running tasks",
+                        default = round(0.8 * os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / GB, 1))
+    parser.add_argument("--decode_memory_factor", type = float,
+                        help = "estimated peak memory of a decode task as a multiple of the master file's size",
+                        default = 2.0)
+    parser.add_argument("--ingest_memory_factor", type = float,
+                        help = "estimated peak memory of an ingest task as a multiple of the .parquet file's size",
+                        default = 10.0)
+    parser.add_argument("--unzip_memory_gb", type = float,
+                        help = "estimated peak memory of an unzip or upload task",
+                        default = 0.5)
+
+    args = parser.parse_args()
+
+    main(args)
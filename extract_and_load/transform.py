@@ -0,0 +1,36 @@
+import argparse
+
+from core import general
+from db_design import Postgres
+
+def main(args: argparse.Namespace):
+    '''
+    Builds the star schema in the cleaned schema (incident_fact, agency_dim, offense_code_dim, and date_dim) from the 
+    raw tables. Only years with files that were ingested since the last run are rebuilt, so this can run after every 
+    db_ingestion.py.
+    '''
+    postgres_config = general.load_yaml(args.postgres_config)
+    
+    postgres = Postgres(credentials = postgres_config.get("postgresql")["credentials"],
+                        schemas = postgres_config.get("postgresql")["schemas"])
+    
+    if args.codes_file:
+        print("Loading offense codes...")
+        postgres.load_offense_codes(general.load_yaml(args.codes_file))
+    
+    rebuilt_years = postgres.update_star_schema()
+    
+    print(f"Done. Rebuilt {len(rebuilt_years)} year(s): {', '.join(rebuilt_years) or 'none'}.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--postgres_config", "-p", 
+                        help = ".yml file with postgresql key, under which exists credentials and schemas keys",
+                        default = "configuration/config.yml")
+    parser.add_argument("--codes_file",
+                        help = ".yml file with group_a_offenses and group_b_offenses keys that name the offense codes",
+                        default = "archive/nibrs_codes.yml")
+    
+    args = parser.parse_args()
+    
+    main(args)